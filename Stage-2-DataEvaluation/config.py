@@ -1,13 +1,27 @@
 import os
-import boto3
+import sys
 import logging
 import numpy as np
+import io
 import cv2
+from PIL import Image
+
+# storage, zip_reader and line_graph are shared with the dataset creation scripts, which hold the only copy of them
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'Stage-2-DataSetcreation'))
+from storage import create_client, SkipUnchanged
 
 TARGET_SHAPE = (1664, 1024)
 THICKNESS = 8
+# 'png' for 8-bit masks or 'png1' for 1-bit masks, which are smaller and still decode to 0/255 with cv2.imread
+MASK_FORMAT = 'png'
+# zlib level of the masks, None for the OpenCV or Pillow default
+PNG_COMPRESSION = None
 
-s3_client = boto3.client('s3')
+# S3 by default, or the local or in-memory storage named by $DATASET_STORAGE, see `storage.create_client`
+s3_client = create_client()
+# With DATASET_SKIP_UNCHANGED=1 masks and JSON files whose bytes equal the stored object are not uploaded again,
+# which needs permission to list the output prefixes, see `storage.SkipUnchanged`
+upload_filter = SkipUnchanged() if os.environ.get('DATASET_SKIP_UNCHANGED') == '1' else None
 
 S3_BUCKET_NAME = "kadaster-magnasoft"
 S3_MAIN_DIR = "Kadaster-AI-ML"
@@ -41,16 +55,44 @@ lines_dir_2 = f"{S3_MAIN_DIR}/{OUT_DIR}/{line_sub_2}/lines_Detection"
 borders_dir_2 = f"{S3_MAIN_DIR}/{OUT_DIR}/{border_sub_2}/borders_Detection"
 buildings_dir_2 = f"{S3_MAIN_DIR}/{OUT_DIR}/{building_sub_2}/buildings_Detection"
 
+def put_object(**kwargs):
+    """
+    `s3_client.put_object` through `upload_filter` when it is set. Returns whether the object was written.
+    """
+    if upload_filter is None:
+        s3_client.put_object(**kwargs)
+        return True
+    return upload_filter.put_object(s3_client, **kwargs)
+
+
+def upload_summary():
+    """
+    Log how many outputs `upload_filter` wrote and skipped.
+    """
+    if upload_filter is not None:
+        logging.info(upload_filter.summary())
+
+
 def save_mask_to_s3(bucket, prefix, filename, mask, image_shape):
     """Save the generated mask image to S3."""
     if mask is not None:
         masked_img = get_masked(mask, None, None, image_shape)
-        _, buffer = cv2.imencode('.png', masked_img)
-        s3_client.put_object(Bucket=bucket, Key=os.path.join(prefix, filename), Body=buffer.tobytes())
-        logging.info(f"Saved mask to S3: s3://{bucket}/{os.path.join(prefix, filename)}")
+        if MASK_FORMAT == 'png1':
+            buffer = io.BytesIO()
+            Image.frombytes('1', masked_img.shape[::-1], np.packbits(masked_img > 0, axis=-1).tobytes()).save(
+                buffer, format='PNG', **({} if PNG_COMPRESSION is None else {'compress_level': PNG_COMPRESSION}))
+            body = buffer.getvalue()
+        else:
+            params = [] if PNG_COMPRESSION is None else [cv2.IMWRITE_PNG_COMPRESSION, PNG_COMPRESSION]
+            _, buffer = cv2.imencode('.png', masked_img, params)
+            body = buffer.tobytes()
+        if put_object(Bucket=bucket, Key=os.path.join(prefix, filename), Body=body):
+            logging.info(f"Saved mask to S3: s3://{bucket}/{os.path.join(prefix, filename)}")
+        else:
+            logging.info(f"Mask unchanged on S3, not uploaded: s3://{bucket}/{os.path.join(prefix, filename)}")
 
 def generate_line_mask(segments, mask_shape):
-    """Generate a mask from given line segments."""
+    """Generate a boolean mask from given line segments."""
     mask = np.zeros(mask_shape, dtype=np.uint8)
 
     if not segments:
@@ -62,26 +104,33 @@ def generate_line_mask(segments, mask_shape):
         if (0 <= start[0] < mask_shape[1] and 0 <= start[1] < mask_shape[0] and
                 0 <= end[0] < mask_shape[1] and 0 <= end[1] < mask_shape[0]):
             cv2.line(mask, (int(start[0]), int(start[1])),
-                     (int(end[0]), int(end[1])), 255,
+                     (int(end[0]), int(end[1])), 1,
                      thickness=THICKNESS, lineType=cv2.LINE_8)
         else:
             logging.warning(f"Skipping out-of-bounds segment: {segment}")
 
-    return np.nonzero(mask) if np.any(mask) else None
+    # Drawn with 1, so the raster can be reinterpreted as booleans without a copy
+    return mask.view(bool) if np.any(mask) else None
 
 
 def get_masked(line_masks, border_masks, building_masks, mask_shape):
-    """Combine masks and visualize if needed."""
+    """Combine boolean masks into a 0/255 image, OR-ing them into the output in place."""
     mask_img = np.zeros(mask_shape, dtype=np.uint8)  # Use the mask shape from JSON
-    if line_masks is not None:
-        mask_img[line_masks[0], line_masks[1]] = 255
-    if building_masks is not None:
-        mask_img[building_masks[0], building_masks[1]] = 255
-    if border_masks is not None:
-        mask_img[border_masks[0], border_masks[1]] = 255
+    for mask in (line_masks, building_masks, border_masks):
+        if mask is not None:
+            np.bitwise_or(mask_img, mask.view(np.uint8), out=mask_img)
+    mask_img *= 255
 
     return mask_img
 
+def list_object_keys(bucket, prefix, suffix=''):
+    """List every key below a prefix, following continuation tokens past the first 1000 keys."""
+    paginator = s3_client.get_paginator('list_objects_v2')
+    return [obj['Key']
+            for page in paginator.paginate(Bucket=bucket, Prefix=prefix)
+            for obj in page.get('Contents', [])
+            if obj['Key'].endswith(suffix)]
+
 def get_attachment_name(path):
     """Extract attachment name from a path."""
     return path.split('/')[2]
@@ -1,11 +1,12 @@
 import json
 import logging
 import zipfile
-import networkx as nx
 from config import (IN_DIR, s3_client, S3_BUCKET_NAME, S3_MAIN_DIR, OUT_DIR, lines_dir_1,
                     lines_dir_2, borders_dir_1, borders_dir_2, buildings_dir_1, buildings_dir_2, save_mask_to_s3,
-                    generate_line_mask, S3_LOG_DIR)
-from io import BytesIO
+                    generate_line_mask, S3_LOG_DIR, list_object_keys, upload_summary)
+from storage import TRANSFER_CONFIG
+from zip_reader import open_zip
+from line_graph import LineGraph
 from tempfile import gettempdir
 import os
 
@@ -73,6 +74,18 @@ def generate_borders_from_json(obs, attachment):
     return generate_line_mask(segments, image_shape)
 
 
+# Line graph of the last sketch, shared by the building masks of all its attachments
+_line_graph_cache = (None, None)
+
+
+def get_line_graph(obs):
+    """Build the line graph of a sketch once instead of once per attachment."""
+    global _line_graph_cache
+    if _line_graph_cache[0] is not obs:
+        _line_graph_cache = (obs, LineGraph(obs['points'].keys(), obs.get('lines', {}).values()))
+    return _line_graph_cache[1]
+
+
 def generate_building_from_json(obs, attachment):
     """Generate building masks from JSON using graph-based shortest paths."""
     points_dict = obs['points']
@@ -83,23 +96,15 @@ def generate_building_from_json(obs, attachment):
     image_shape = (dimensions[1], dimensions[0])  # Use (y, x) for mask creation
     # Use the dimensions for mask creation
 
-    g = nx.Graph()
-    g.add_nodes_from(points_dict.keys())
-
-    for line in obs.get('lines', {}).values():
-        line_points = line['points']
-        for i in range(1, len(line_points)):
-            g.add_edge(line_points[i - 1], line_points[i])
+    g = get_line_graph(obs)
 
     segments = []
     for building in buildings.values():
         for i in range(1, len(building['points'])):
-            try:
-                path = nx.shortest_path(
-                    g, building['points'][i - 1], building['points'][i]
-                )
+            path = g.shortest_path(building['points'][i - 1], building['points'][i])
+            if path is not None:
                 segments.extend([[path[k - 1], path[k]] for k in range(1, len(path))])
-            except nx.NetworkXNoPath:
+            else:
                 logging.warning("No path found between points.")
                 segments.append([building['points'][i - 1], building['points'][i]])
 
@@ -113,9 +118,10 @@ def read_zip(s3_bucket, s3_key, output_bucket):
     """Read a zip file from S3 and process its contents."""
     logging.info(f"fetching ZIP file from S3: s3://{s3_bucket}/{s3_key}")
 
-    zip_obj = s3_client.get_object(Bucket=s3_bucket, Key=s3_key)
-    zip_data_stream = zip_obj['Body']  # This is a streaming body (not the entire file in memory)
-    with zipfile.ZipFile(BytesIO(zip_data_stream.read()), 'r') as archive:
+    # Only the central directory and the snapshot JSONs are fetched, not the attachment rasters
+    zip_file = open_zip(s3_client, s3_bucket, s3_key,
+                        members=lambda name: name.startswith('observations/snapshots/') and name.endswith('.json'))
+    with zip_file, zipfile.ZipFile(zip_file, 'r') as archive:
         prefix_1 = 'observations/snapshots/latest/'
         postfix_1 = '.json'
         prefix_2 = 'observations/snapshots/LineDetector/'
@@ -185,14 +191,12 @@ if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
     try:
         # List ZIP files in the S3 bucket
-        response = s3_client.list_objects_v2(Bucket=S3_BUCKET_NAME, Prefix=f"{S3_MAIN_DIR}/{IN_DIR}")
-        for obj in response.get('Contents', []):
-            s3_key = obj['Key']
-            if s3_key.endswith('.zip'):  # Process only ZIP files
-                logging.info(f"Processing ZIP files from S3: {s3_key}")
-                read_zip(S3_BUCKET_NAME, s3_key, OUT_DIR)
+        for s3_key in list_object_keys(S3_BUCKET_NAME, f"{S3_MAIN_DIR}/{IN_DIR}", '.zip'):
+            logging.info(f"Processing ZIP files from S3: {s3_key}")
+            read_zip(S3_BUCKET_NAME, s3_key, OUT_DIR)
     except Exception as e:
         logging.error(f"Error listing or processing ZIP files from S3: {e}")
+    upload_summary()
 
     # Upload the log file to S3 after processing is done
     try:
@@ -200,8 +204,7 @@ if __name__ == "__main__":
         logging.info(f"Uploading log file to S3: {s3_log_key}")
 
         # Upload the log file to S3
-        with open(log_file_path, 'rb') as log_file:
-            s3_client.put_object(Body=log_file, Bucket=S3_BUCKET_NAME, Key=s3_log_key)
+        s3_client.upload_file(log_file_path, S3_BUCKET_NAME, s3_log_key, Config=TRANSFER_CONFIG)
         logging.info("log file uploaded successfully.")
 
     except Exception as e:
@@ -2,10 +2,10 @@ import os
 import json
 import zipfile
 import logging
-import boto3
-from config import (S3_BUCKET_NAME, s3_client, OUT_DIR_TEXT_BOX,
-                    OUT_DIR_TEXT_BOX1, S3_MAIN_DIR, OUT_DIR, IN_DIR, S3_LOG_DIR)
-from io import BytesIO
+from config import (S3_BUCKET_NAME, s3_client, put_object, upload_summary, OUT_DIR_TEXT_BOX,
+                    OUT_DIR_TEXT_BOX1, S3_MAIN_DIR, OUT_DIR, IN_DIR, S3_LOG_DIR, list_object_keys)
+from storage import TRANSFER_CONFIG
+from zip_reader import open_zip
 from tempfile import gettempdir
 
 
@@ -51,8 +51,10 @@ def read_zip(zip_key, prefix, postfix, output_dir):
     logging.info(f'Reading zip file from s3 Bucket: {zip_key}')
     try:
         # Download zip file from s3
-        response = s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=zip_key)
-        with zipfile.ZipFile(BytesIO(response['Body'].read()), 'r') as archive:
+        # Fetch only the central directory and the matching sketch files with ranged reads
+        zip_file = open_zip(s3_client, S3_BUCKET_NAME, zip_key,
+                            members=lambda name: name.startswith(prefix) and name.endswith(postfix))
+        with zip_file, zipfile.ZipFile(zip_file, 'r') as archive:
             sketch_files = [
                 x for x in archive.namelist()
                 if x.startswith(prefix) and x.endswith(postfix)
@@ -72,12 +74,15 @@ def read_zip(zip_key, prefix, postfix, output_dir):
 
                     # Save extracted data of JSON files to S3
                     output_json_path = os.path.join(output_dir, f'{sketch_name}.json')
-                    s3_client.put_object(
+                    written = put_object(
                         Bucket=S3_BUCKET_NAME,
                         Key=output_json_path,
                         Body=json.dumps(text_data, indent=4)
                     )
-                    logging.info(f"Data is successfully saved in {S3_BUCKET_NAME} {output_json_path}")
+                    if written:
+                        logging.info(f"Data is successfully saved in {S3_BUCKET_NAME} {output_json_path}")
+                    else:
+                        logging.info(f"Data is unchanged in {S3_BUCKET_NAME} {output_json_path}, not uploaded")
 
                 except Exception as e:
                     logging.error(f'Error processing sketch {sketch_name}: {e}')
@@ -90,13 +95,11 @@ if __name__ == '__main__':
 
     # List objects in the input bucket
     try:
-        response = s3_client.list_objects_v2(Bucket=S3_BUCKET_NAME, Prefix=f"{S3_MAIN_DIR}/{IN_DIR}")
-        projects = response.get('Contents', [])
-        if 'Contents' not in response:
+        projects = list_object_keys(S3_BUCKET_NAME, f"{S3_MAIN_DIR}/{IN_DIR}")
+        if not projects:
             logging.error(f"No contents found in the {S3_MAIN_DIR}")
         else:
-            for j, obj in enumerate(projects):
-                zip_key = obj['Key']
+            for j, zip_key in enumerate(projects):
                 logging.info(f'Processing project {j + 1} / {len(projects)}: {zip_key}.')
 
                 # Define prefixes and postfixes
@@ -112,14 +115,14 @@ if __name__ == '__main__':
                 read_zip(zip_key, prefix_2, postfix_2, OUT_DIR_TEXT_BOX1)
     except Exception as e:
         logging.error(f"Error listing objects in bucket {IN_DIR}: {e}")
+    upload_summary()
 
     # Upload the log file to S3 after processing is done
     try:
         s3_log_key = f"{S3_MAIN_DIR}/{S3_LOG_DIR}/text_box_detector_json.txt"
 
         # Upload log file to S3
-        with open(log_file_path, 'rb') as log_file:
-            s3_client.put_object(Body=log_file, Bucket=S3_BUCKET_NAME, Key=s3_log_key)
+        s3_client.upload_file(log_file_path, S3_BUCKET_NAME, s3_log_key, Config=TRANSFER_CONFIG)
         logging.info(f"Log file uploaded successfully{S3_BUCKET_NAME} {s3_log_key}")
 
     except Exception as e:
@@ -1,84 +1,67 @@
 # border_mask_generator.py
 import logging
-from common import (read_zip, generate_line_mask, get_masked, TARGET_SHAPE, IN_DIR, S3_BUCKET_NAME, S3_MAIN_DIR,
-                    upload_image_to_s3, s3_client, S3_LOG_DIR)
-from tempfile import gettempdir
-import os.path
+from common import (generate_polyline_mask, attachment_polylines, write_label, IN_DIR, S3_BUCKET_NAME, S3_MAIN_DIR,
+                    setup_logging, upload_log_file, parse_run_args, shard_name, configure_rendering, configure_output,
+                    configure_uploads, configure_storage, connection_pool_size, configure_zip_access, configure_rasters)
+from parallel import create_unit_runner
+from pipeline import run_zips
+from manifest import open_run_manifest
+from archive import open_archive
+from listing import list_zip_objects, schedule_zips, shard_zips
 
 # S3 Configuration
 S3_SUB_DIR = "retrain_data/border/label"
 
 
-# Get a cross-platform temporary directory and define lof file path
-temp_dir = gettempdir() # This dynamically retrieves the temp directory (e.g., /tmp on Linux, C:\Temp on Windows)
-log_file_path = os.path.join(temp_dir, "border_mask_generator.log")
+def border_mask_from_json(obs, image_shape, attachment):
+    return generate_polyline_mask(attachment_polylines(obs, 'semantic_lines', attachment), image_shape)
 
-# Ensure the directory for the log file exists
-os.makedirs(os.path.dirname(log_file_path), exist_ok=True)
-# Set up logging to a local file
-file_handler = logging.FileHandler(log_file_path)
-stream_handler = logging.StreamHandler()
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s;%(levelname)s;%(message)s',
-    handlers=[file_handler, stream_handler]
-)
 
 def generate_borders_from_json(obs, sketch_name, image_shape, attachment):
-    semantic_lines, points_dict = obs['semantic_lines'], obs['points']
-    semantic_lines = {k: v for k, v in semantic_lines.items() if v.get('attachment') == attachment}
-    segments = []
-    for line, details in semantic_lines.items():
-        points = details['points']
-        for start, stop in zip(points, points[1:]):
-            segments.append([points_dict[start]['position'], points_dict[stop]['position']])
-    border_masks = generate_line_mask(segments, image_shape)
-    if border_masks:
-        masked_img = get_masked(None, None, border_masks, TARGET_SHAPE)
-        s3_key = f"{S3_MAIN_DIR}/{S3_SUB_DIR}/{sketch_name}.{attachment}.png"
-        
+    border_masks = border_mask_from_json(obs, image_shape, attachment)
+    if border_masks is not None:
         # Upload to S3
-        upload_image_to_s3(masked_img, S3_BUCKET_NAME, s3_key)
+        return write_label(border_masks, S3_SUB_DIR, sketch_name, attachment)
 
 
 if __name__ == '__main__':
-    logging.basicConfig(level=logging.INFO, format='%(asctime)s;%(levelname)s;%(message)s')
+    args = parse_run_args("Generate border masks for every sketch attachment in the vector-data ZIPs.")
+    configure_rendering(args.direct_render, args.supersample, args.tile_threshold * 1_000_000)
+    configure_output(args.label_format, args.png_compression)
+    configure_uploads(args.skip_unchanged)
+    configure_storage(args.storage, connection_pool_size(args))
+    configure_zip_access(args.zip_access, args.zip_memory_limit)
+    configure_rasters(args.export_rasters)
+    run_name = shard_name("border_mask_generator", args)
+    log_file_path, file_handler = setup_logging(run_name)
+    runner = create_unit_runner(args.workers)
+    manifest, archive, completed = None, None, False
 
     try:
+        manifest = open_run_manifest(run_name, args)
+        archive = open_archive(run_name, args)
         # List ZIP files in the S3 Bucket
-        response = s3_client.list_objects_v2(Bucket=S3_BUCKET_NAME, Prefix = f"{S3_MAIN_DIR}/{IN_DIR}")
-        if 'Contents' not in response:
-            logging.error(f"No contents found in the {S3_MAIN_DIR}")
+        zip_objects = list_zip_objects(S3_BUCKET_NAME, f"{S3_MAIN_DIR}/{IN_DIR}", workers=args.list_workers)
+        zip_objects = shard_zips(zip_objects, args.shard_index, args.shard_count)
+        if not zip_objects:
+            logging.error(f"No ZIP files found in {S3_MAIN_DIR}/{IN_DIR}")
         else:
-            for obj in response.get('Contents', []):
-                s3_key = obj['Key']
-                if s3_key.endswith('.zip'):
-                    logging.info(f"Processing ZIP files from S3: {s3_key}")
-                    try:
-                        read_zip(S3_BUCKET_NAME, s3_key, generate_borders_from_json)
-                        logging.info(f"Successfully processed ZIP file: {s3_key}")
-                    except Exception as e:
-                        logging.error(f"Failed to process zip file {s3_key}: {e}")
+            logging.info(f"Found {len(zip_objects)} ZIP files, {sum(obj['Size'] for obj in zip_objects)} bytes.")
+            zip_keys = schedule_zips(zip_objects, args.order)
+            if manifest is not None:
+                manifest.set_listing(zip_objects)
+            run_zips(S3_BUCKET_NAME, zip_keys, generate_borders_from_json, runner=runner, options=args,
+                     manifest=manifest, archive=archive)
+        completed = True
     except Exception as e:
         logging.error(f"Error listing or processing ZIP files from S3: {e}")
+    finally:
+        if runner is not None:
+            runner.shutdown()
+        if archive is not None:
+            archive.close(completed)
+        if manifest is not None:
+            manifest.close(completed)
 
     # Upload the log file to S3 after processing is done
-    try:
-        s3_log_key=f"{S3_MAIN_DIR}/{S3_LOG_DIR}/border_mask_generator.txt"
-        logging.info(f"Uploading log file to S3: {s3_log_key}")
-        
-        # Upload the log file to S3
-        with open(log_file_path, 'rb') as log_file:
-            s3_client.put_object(Body=log_file, Bucket=S3_BUCKET_NAME, Key=s3_log_key)
-        logging.info("log file uploaded successfully.")
-    
-    except Exception as e:
-        logging.error(f"Error uploading log file to S3: {e}")
-    
-    finally:
-        # Close the logging file handler
-        file_handler.close()
-        logging.getLogger().removeHandler(file_handler)
-        if os.path.exists(log_file_path):
-            os.remove(log_file_path)
-            logging.info("Cleaned up the local log file.")
+    upload_log_file(log_file_path, file_handler, run_name)
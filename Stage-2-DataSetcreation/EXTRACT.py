@@ -0,0 +1,186 @@
+# dataset_extractor.py
+import logging
+import argparse
+from functools import partial
+from common import (IN_DIR, S3_BUCKET_NAME, S3_MAIN_DIR, setup_logging, upload_log_file, shard_name,
+                    add_run_arguments, check_run_arguments, configure_rendering, configure_output, configure_uploads,
+                    configure_storage, connection_pool_size, configure_zip_access, configure_rasters, write_label,
+                    LABEL_CHANNELS)
+from parallel import create_unit_runner
+from pipeline import run_zips
+from manifest import open_run_manifest
+from archive import open_archive
+from listing import list_zip_objects, schedule_zips, shard_zips
+from LINE import generate_lines_from_json, line_mask_from_json
+from BORDER import generate_borders_from_json, border_mask_from_json
+from BUILDING import generate_building_from_json, building_mask_from_json
+from TEXT_BOX import (process_textbox_sketch, replay_textbox_sketch, save_coco_splits, add_annotation_arguments,
+                      configure_annotations, coco_part)
+
+# Products rendered once per attachment
+ATTACHMENT_PRODUCTS = {
+    'line': generate_lines_from_json,
+    'border': generate_borders_from_json,
+    'building': generate_building_from_json,
+}
+
+# The masks of the per-attachment products, for the combined labels
+ATTACHMENT_MASKS = {
+    'line': line_mask_from_json,
+    'border': border_mask_from_json,
+    'building': building_mask_from_json,
+}
+
+# Labels holding all per-attachment products, one channel per product in LABEL_CHANNELS order
+COMBINED_SUB_DIR = "retrain_data/combined/label"
+
+# Products built once per sketch
+SKETCH_PRODUCTS = {
+    'textbox': process_textbox_sketch,
+}
+
+# Replay the payload a per-sketch product returned, for sketches skipped by an incremental run
+SKETCH_REPLAYS = {
+    'textbox': replay_textbox_sketch,
+}
+
+PRODUCTS = [*ATTACHMENT_PRODUCTS, *SKETCH_PRODUCTS]
+
+
+def process_attachment(obs, sketch_name, image_shape, attachment, products=(), combined=False):
+    """
+    Run every selected per-attachment product on an already parsed sketch and return the keys of the outputs.
+    A failing product is logged and does not stop the other products, but the attachment raises once they ran so
+    that its sketch is processed again by the next run. With `combined` the products are written as the channels
+    of a single label instead of one label each.
+    """
+    if combined:
+        return process_combined_attachment(obs, sketch_name, image_shape, attachment, products)
+    output_keys, failed = [], []
+    for product in products:
+        try:
+            output_key = ATTACHMENT_PRODUCTS[product](obs, sketch_name, image_shape, attachment)
+            if output_key is not None:
+                output_keys.append(output_key)
+        except Exception as e:
+            logging.error(f"Failed to generate {product} output for {sketch_name}.{attachment}: {e}")
+            failed.append(product)
+    if failed:
+        raise RuntimeError(f"{', '.join(failed)} failed")
+    return output_keys
+
+
+def process_combined_attachment(obs, sketch_name, image_shape, attachment, products):
+    masks, failed = {}, []
+    for product in products:
+        try:
+            masks[product] = ATTACHMENT_MASKS[product](obs, image_shape, attachment)
+        except Exception as e:
+            logging.error(f"Failed to generate {product} mask for {sketch_name}.{attachment}: {e}")
+            failed.append(product)
+    if failed:
+        # A label with a missing channel would pass for a complete one
+        raise RuntimeError(f"{', '.join(failed)} failed")
+    if all(mask is None for mask in masks.values()):
+        logging.warning(f"No mask generated for {sketch_name}.{attachment}")
+        return []
+    return [write_label([masks.get(product) for product in LABEL_CHANNELS], COMBINED_SUB_DIR, sketch_name,
+                        attachment)]
+
+
+def process_sketch(obs, sketch_name, products=()):
+    """
+    Run every selected per-sketch product on an already parsed sketch and return their payloads by product.
+    Like `process_attachment` it raises once all products ran if one of them failed.
+    """
+    payload, failed = {}, []
+    for product in products:
+        try:
+            payload[product] = SKETCH_PRODUCTS[product](obs, sketch_name)
+        except Exception as e:
+            logging.error(f"Failed to generate {product} output for {sketch_name}: {e}")
+            failed.append(product)
+    if failed:
+        raise RuntimeError(f"{', '.join(failed)} failed")
+    return payload
+
+
+def replay_sketch(payload):
+    for product, product_payload in payload.items():
+        if product_payload is not None:
+            SKETCH_REPLAYS[product](product_payload)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Generate the line, border, building and textbox datasets from a single pass over the ZIPs.")
+    parser.add_argument('--products', nargs='+', choices=PRODUCTS, default=PRODUCTS,
+                        help="Products to generate (default: all).")
+    parser.add_argument('--combined-labels', action='store_true',
+                        help=f"Write the line, building and border masks of an attachment as the channels of one "
+                             f"label in {COMBINED_SUB_DIR} instead of one label per product.")
+    add_run_arguments(parser)
+    add_annotation_arguments(parser)
+    args = check_run_arguments(parser, parser.parse_args())
+    if args.combined_labels and args.label_format == 'png1':
+        parser.error("--combined-labels needs a multi-channel --label-format: png or npy")
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    configure_rendering(args.direct_render, args.supersample, args.tile_threshold * 1_000_000)
+    configure_output(args.label_format, args.png_compression)
+    configure_uploads(args.skip_unchanged)
+    configure_storage(args.storage, connection_pool_size(args))
+    configure_zip_access(args.zip_access, args.zip_memory_limit)
+    configure_rasters(args.export_rasters)
+    configure_annotations(not args.raster_annotations)
+    run_name = shard_name("dataset_extractor", args)
+    log_file_path, file_handler = setup_logging(run_name)
+
+    attachment_products = [p for p in args.products if p in ATTACHMENT_PRODUCTS]
+    sketch_products = [p for p in args.products if p in SKETCH_PRODUCTS]
+    process_fn = partial(process_attachment, products=attachment_products, combined=args.combined_labels) \
+        if attachment_products else None
+    sketch_fn = partial(process_sketch, products=sketch_products) if sketch_products else None
+    logging.info(f"Generating products: {', '.join(args.products)}")
+    # The textbox COCO builder keeps global state and always runs in this process
+    runner = create_unit_runner(args.workers) if process_fn is not None or args.export_rasters else None
+    # Each product selection keeps its own manifest, the outputs depend on it
+    manifest_name = shard_name(f"dataset_extractor.{'.'.join(sorted(args.products))}"
+                               f"{'.combined' if args.combined_labels else ''}", args)
+    manifest, archive, completed = None, None, False
+
+    try:
+        manifest = open_run_manifest(manifest_name, args)
+        archive = open_archive(manifest_name, args)
+        # List ZIP files in the S3 bucket
+        zip_objects = list_zip_objects(S3_BUCKET_NAME, f"{S3_MAIN_DIR}/{IN_DIR}", workers=args.list_workers)
+        zip_objects = shard_zips(zip_objects, args.shard_index, args.shard_count)
+        if not zip_objects:
+            logging.error(f"No ZIP files found in {S3_MAIN_DIR}/{IN_DIR}")
+        else:
+            logging.info(f"Found {len(zip_objects)} ZIP files, {sum(obj['Size'] for obj in zip_objects)} bytes.")
+            zip_keys = schedule_zips(zip_objects, args.order)
+            if manifest is not None:
+                manifest.set_listing(zip_objects)
+            run_zips(S3_BUCKET_NAME, zip_keys, process_fn, sketch_fn, runner=runner, options=args,
+                     manifest=manifest, replay_fn=replay_sketch, archive=archive)
+        completed = True
+    except Exception as e:
+        logging.error(f"Error listing or processing ZIP files from S3: {e}")
+    finally:
+        if runner is not None:
+            runner.shutdown()
+        if archive is not None:
+            archive.close(completed)
+
+    if 'textbox' in sketch_products:
+        save_coco_splits(coco_part(args))
+    # A journal is kept until the COCO files are saved, they are rebuilt from it on --resume
+    if manifest is not None:
+        manifest.close(completed)
+
+    # Upload the log file to S3 after processing is done
+    upload_log_file(log_file_path, file_handler, run_name)
@@ -0,0 +1,83 @@
+# coco_merger.py
+import json
+import logging
+import argparse
+import posixpath
+import common
+from common import S3_BUCKET_NAME, S3_MAIN_DIR, setup_logging, upload_log_file, add_storage_arguments
+from listing import list_objects
+from coco_writer import CocoWriter
+from storage import TRANSFER_CONFIG
+from TEXT_BOX import OUT_DIR, PARTIAL_DIR, SPLITS
+
+
+def list_partials(parts=None):
+    """
+    Group the partial COCO files below PARTIAL_DIR by split: `{split: [key, ...]}`, optionally only for the
+    named parts.
+    """
+    prefix = f"{S3_MAIN_DIR}/{PARTIAL_DIR}/"
+    partials = {split: [] for split in SPLITS}
+    for obj in list_objects(S3_BUCKET_NAME, prefix, suffix='_annotations.json'):
+        part, file_name = posixpath.split(obj['Key'][len(prefix):])
+        split = file_name[:-len('_annotations.json')]
+        if split in partials and (parts is None or part in parts):
+            partials[split].append(obj['Key'])
+    return {split: sorted(keys) for split, keys in partials.items()}
+
+
+def merge_partials(partials):
+    """
+    Stream the images and annotations of the partial files into a `CocoWriter`. The ids are derived from stable keys
+    and kept as they are; entries that several parts contain (e.g. a ZIP processed twice) are written once.
+    Returns the writer and the merged categories.
+    """
+    writer, categories = None, {}
+    for split, keys in partials.items():
+        seen_images, seen_annotations = set(), set()
+        for key in keys:
+            dataset = json.loads(common.s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=key)['Body'].read())
+            if writer is None:
+                writer = CocoWriter(dataset['info'], dataset['licenses'], SPLITS)
+            categories.update((category['id'], category) for category in dataset['categories'])
+
+            images = [image for image in dataset['images'] if (image['id'], image['file_name']) not in seen_images]
+            seen_images.update((image['id'], image['file_name']) for image in images)
+            annotations = [annotation for annotation in dataset['annotations']
+                           if annotation['id'] not in seen_annotations]
+            seen_annotations.update(annotation['id'] for annotation in annotations)
+
+            writer.add(split, images, annotations)
+            logging.info(f"Merged {len(images)} images and {len(annotations)} annotations from {key}, skipped "
+                         f"{len(dataset['images']) - len(images)} and "
+                         f"{len(dataset['annotations']) - len(annotations)} duplicates.")
+    return writer, [categories[category_id] for category_id in sorted(categories)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Combine the partial textbox COCO datasets into the final splits.")
+    parser.add_argument('--parts', nargs='+', default=None,
+                        help="Names of the partial datasets to merge (default: all).")
+    args = add_storage_arguments(parser).parse_args()
+    common.configure_storage(args.storage)
+    log_file_path, file_handler = setup_logging("coco_merger")
+
+    try:
+        partials = list_partials(args.parts)
+        if not any(partials.values()):
+            logging.error(f"No partial COCO files found in {S3_MAIN_DIR}/{PARTIAL_DIR}")
+        else:
+            writer, categories = merge_partials(partials)
+            try:
+                for split, path in writer.close(categories).items():
+                    s3_key = f"{S3_MAIN_DIR}/{OUT_DIR}/{split}_annotations.json"
+                    common.s3_client.upload_file(path, S3_BUCKET_NAME, s3_key,
+                                                 ExtraArgs={'ContentType': 'application/json'}, Config=TRANSFER_CONFIG)
+                    logging.info(f"{split.capitalize()} annotations saved to S3: {s3_key}")
+            finally:
+                writer.cleanup()
+    except Exception as e:
+        logging.error(f"Error merging the partial COCO files: {e}")
+
+    # Upload the log file to S3 after processing is done
+    upload_log_file(log_file_path, file_handler, "coco_merger")
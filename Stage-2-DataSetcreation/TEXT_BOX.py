@@ -1,25 +1,26 @@
 import os
 import cv2
-import json
-import zipfile
 import logging
 import datetime
 import matplotlib.pyplot as plt
-import boto3
 import numpy as np
+import argparse
+import common
 import pycococreatortools
-from io import BytesIO
-from tempfile import gettempdir
-import os.path
-from common import S3_LOG_DIR
+from functools import partial
+from common import read_zip as read_sketches, setup_logging, upload_log_file
+from listing import list_zip_objects, shard_zips, schedule_zips
+from pipeline import run_zips
+from manifest import open_run_manifest
+from coco_writer import CocoWriter, hash_split, coco_id
+from storage import TRANSFER_CONFIG
 
 S3_BUCKET_NAME = "kadaster-magnasoft"
 S3_MAIN_DIR = "Kadaster-AI-ML"
 IN_DIR = "vector-data"
 OUT_DIR = "retrain_data/textbox/label"
-
-
-s3_client = boto3.client('s3')
+# Partial datasets of separate runs, combined into OUT_DIR by MERGE_COCO.py
+PARTIAL_DIR = "retrain_data/textbox/partial"
 
 TRAIN_SPLIT = 70
 TEST_SPLIT = 15
@@ -27,23 +28,35 @@ VALIDATION_SPLIT = 15
 
 TARGET_SHAPE = (1664, 1024)
 
-# Get a cross-platform temporary directory and define lof file path
-temp_dir = gettempdir() # This dynamically retrieves the temp directory (e.g., /tmp on Linux, C:\Temp on Windows)
-log_file_path = os.path.join(temp_dir, "textbox_generator.log")
+# Derive the annotations of the text boxes from their corners instead of tracing the contours of rasterized masks
+ANALYTIC_ANNOTATIONS = True
+
+os.makedirs(OUT_DIR, exist_ok=True)
 
-# Ensure the directory for the log file exists
-os.makedirs(os.path.dirname(log_file_path), exist_ok=True)
-# Set up logging to a local file
-file_handler = logging.FileHandler(log_file_path)
-stream_handler = logging.StreamHandler()
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s;%(levelname)s;%(message)s',
-    handlers=[file_handler, stream_handler]
-)
 
+def configure_annotations(analytic=True):
+    global ANALYTIC_ANNOTATIONS
+    ANALYTIC_ANNOTATIONS = analytic
+
+
+def add_annotation_arguments(parser):
+    parser.add_argument('--raster-annotations', action='store_true',
+                        help="Trace the text box annotations from rasterized masks instead of computing them from "
+                             "the box corners.")
+    parser.add_argument('--coco-part', default=None,
+                        help="Save the COCO files as the named partial dataset, to be combined with MERGE_COCO.py "
+                             "(default: the shard, when the ZIPs are sharded).")
+    return parser
+
+
+def coco_part(args):
+    """
+    The partial dataset a run saves its COCO files as: --coco-part, or its shard when the ZIPs are sharded.
+    """
+    if args.coco_part is None and args.shard_count > 1:
+        return f"shard-{args.shard_index}-of-{args.shard_count}"
+    return args.coco_part
 
-os.makedirs(OUT_DIR, exist_ok=True)
 
 def upload_image_to_s3(image, s3_bucket, s3_key):
     """
@@ -52,7 +65,7 @@ def upload_image_to_s3(image, s3_bucket, s3_key):
     try:
         # Encode image to PNG format in memory
         _, buffer = cv2.imencode('.png', image)
-        s3_client.put_object(Bucket=s3_bucket, Key=s3_key, Body=BytesIO(buffer), ContentType='image/png')
+        common.s3_client.put_object(Bucket=s3_bucket, Key=s3_key, Body=buffer.tobytes(), ContentType='image/png')
         logging.info(f"Uploaded to S3: s3://{s3_bucket}/{s3_key}")
     except Exception as e:
         logging.error(f"Error uploading image to S3: {e}")
@@ -60,7 +73,14 @@ def upload_image_to_s3(image, s3_bucket, s3_key):
 
 def generate_box_mask(box, mask_shape):
     rct = ((box[0][0], box[0][1]), (box[1][0], box[1][1]), box[2])
+    if common.RENDER_DIRECT:
+        return common.render_polygon_at_target(cv2.boxPoints(rct), mask_shape).view(np.uint8)
+
     corner_points = cv2.boxPoints(rct).astype(np.int32)
+    if common.use_tiles(mask_shape):
+        return common.render_tiled(lambda canvas, x0, y0: cv2.fillConvexPoly(canvas, corner_points - (x0, y0), 1),
+                                   mask_shape, (*corner_points.min(axis=0), *corner_points.max(axis=0)))
+
     mask = np.zeros(mask_shape, dtype=np.uint8)
     mask = cv2.fillConvexPoly(mask, corner_points, 1)
 
@@ -69,16 +89,33 @@ def generate_box_mask(box, mask_shape):
     return mask
 
 
-def generate_parcel_mask_from_json(obs, color, image_shape):
-    filtered_texts = {k: item for k, item in obs['text'].items() if item['type'] == 'parcel' and item['color'] == color}
-    masks = [generate_box_mask(filtered_texts[text]['box'], image_shape) for text in filtered_texts]
+def generate_box_polygon(box, mask_shape):
+    """
+    Corners of a text box in TARGET_SHAPE pixel-edge coordinates, where pixel (0, 0) spans [0, 1] x [0, 1].
+    """
+    rct = ((box[0][0], box[0][1]), (box[1][0], box[1][1]), box[2])
+    scale = np.array([TARGET_SHAPE[1] / mask_shape[1], TARGET_SHAPE[0] / mask_shape[0]])
+    # cv2.boxPoints works in pixel-center coordinates, like the cv2 drawing functions
+    return (cv2.boxPoints(rct).astype(np.float64) + 0.5) * scale
+
+
+def on_attachment(text, attachment):
+    # Texts that do not name their attachment are placed on every attachment of the sketch
+    return attachment is None or text.get('attachment', attachment) == attachment
+
+
+def generate_parcel_mask_from_json(obs, color, image_shape, box_fn=generate_box_mask, attachment=None):
+    filtered_texts = {k: item for k, item in obs['text'].items()
+                      if item['type'] == 'parcel' and item['color'] == color and on_attachment(item, attachment)}
+    masks = [box_fn(filtered_texts[text]['box'], image_shape) for text in filtered_texts]
 
     return masks
 
 
-def generate_mask_from_json(obs, text_type, image_shape):
-    filtered_texts = {key: item for key, item in obs['text'].items() if item['type'] == text_type}
-    masks = [generate_box_mask(filtered_texts[text]['box'], image_shape) for text in filtered_texts]
+def generate_mask_from_json(obs, text_type, image_shape, box_fn=generate_box_mask, attachment=None):
+    filtered_texts = {key: item for key, item in obs['text'].items()
+                      if item['type'] == text_type and on_attachment(item, attachment)}
+    masks = [box_fn(filtered_texts[text]['box'], image_shape) for text in filtered_texts]
 
     return masks
 
@@ -142,203 +179,224 @@ LICENSES = [
     }
 ]
 
+# Category ids are fixed, so that datasets built separately agree on them
+CATEGORY_IDS = {
+    'red_parcel': 1,
+    'blue_parcel': 2,
+    'black_parcel': 3,
+    'measurement': 4,
+    'coordinate': 5,
+    'year': 6,
+}
+
+# Categories that have been annotated
 categories = {}
 
-coco_output = {
-    "info": INFO,
-    "images": [],
-    "annotations": [],
-    "licenses": LICENSES,
-}
+# Percentage of the sketches in each split. A sketch's split only depends on its name, see `hash_split`.
+SPLITS = {'train': TRAIN_SPLIT, 'validate': VALIDATION_SPLIT, 'test': TEST_SPLIT}
 
-image_id = 0
-annotation_id = 0
-
-
-def read_zip(s3_bucket,s3_key, measurement_masks=True, parcel_number_masks=True, coordinate_masks=True,
-             year_masks=True):
-    global image_id, annotation_id
-
-    zip_obj = s3_client.get_object(Bucket=s3_bucket, Key=s3_key)
-    with zipfile.ZipFile(BytesIO(zip_obj['Body'].read()), 'r') as archive:
-        prefix, postfix = 'observations/snapshots/latest/', '.latest.json'
-        sketch_files = list(filter(lambda x: x.startswith(prefix) and x.endswith(postfix), archive.namelist()))
-        for i, sketch_file in enumerate(sketch_files):
-            sketch_name = sketch_file[len(prefix):-len(postfix)]
-            logging.info(f'Processing sketch: {i}: {sketch_name}.')
-
-            with archive.open(sketch_file, 'r') as fh:
-                json_data = json.loads(fh.read())
-
-            # Directly attempt to extract image shape from JSON
-            # Initialize a list to store processed attachments
-            processed_attachments = []
-
-            for attachment, details in json_data['attachments'].items():
-                try:
-                    # Check if 'vectorize' is present and True in the attachment's details
-                    if details.get('properties', {}).get('vectorize',
-                                                         False):  # Check if vectorize is True in properties
-                        properties = details['properties']
-
-                        # Safely access 'dimensions' if it exists
-                        dimensions = properties.get('dimensions', None)
-                        if dimensions:
-                            height, width = dimensions[1], dimensions[
-                                0]  # Assuming dimensions[1] = height and dimensions[0] = width
-                            image_shape = (height, width)
-
-                            # Collect the processed attachment
-                            processed_attachments.append({
-                                "attachment": attachment,
-                                "image_shape": image_shape
-                            })
-                            logging.info(f"Processed {attachment}: {image_shape}")
-                        else:
-                            logging.warning(f"Missing 'dimensions' for attachment {attachment}. Skipping...")
-                    else:
-                        logging.info(f"Skipping attachment {attachment} as vectorize is False.")
-                except KeyError as e:
-                    logging.warning(f"Missing key {e} for attachment {attachment}. Skipping...")
-                except Exception as e:
-                    logging.error(f"Unexpected error processing attachment {attachment}: {e}")
-                continue
-            # Log the collected processed attachments
-            logging.info(f"Processed Attachments: {processed_attachments}")
-
-            categories_to_instances = {}
-            if parcel_number_masks:
-                categories_to_instances['red_parcel'] = \
-                    generate_parcel_mask_from_json(json_data, 'red', image_shape)
-
-            if parcel_number_masks:
-                categories_to_instances['blue_parcel'] = \
-                    generate_parcel_mask_from_json(json_data, 'blue', image_shape)
-
-            if parcel_number_masks:
-                categories_to_instances['black_parcel'] = \
-                    generate_parcel_mask_from_json(json_data, 'black', image_shape)
-
-            if measurement_masks:
-                categories_to_instances['measurement'] = \
-                    generate_mask_from_json(json_data, 'measurement', image_shape)
-
-            if coordinate_masks:
-                categories_to_instances['coordinate'] = \
-                    generate_mask_from_json(json_data, 'coordinate', image_shape)
-
-            if year_masks:
-                categories_to_instances['year'] = \
-                    generate_mask_from_json(json_data, 'year', image_shape)
-
-            for processed_attachment in processed_attachments:
-                # Extract the attachment name for each processed attachment
-                attachment = processed_attachment['attachment']
-                # Construct the file name for the processed attachment
-                file_name = f'{sketch_name}.{attachment}.jpg'
-                # Create the COCO image info using the fixed target shape
-                image_info = pycococreatortools.create_image_info(
-                    image_id, file_name, TARGET_SHAPE  # Use the predefined TARGET_SHAPE
-                )
-
-                # Append the created image info to the COCO output
-                coco_output["images"].append(image_info)
-
-            for category, masks in categories_to_instances.items():
-                if category not in categories:
-                    categories[category] = len(categories) + 1
-
-                class_id = categories[category]
-                for index, binary_mask in enumerate(masks):
-                    category_info = {'id': class_id, 'is_crowd': False}
-                    annotation_info = pycococreatortools.create_annotation_info(
-                        annotation_id, image_id, category_info, binary_mask, tolerance=2)
-
-                    if annotation_info is not None:
-                        coco_output["annotations"].append(annotation_info)
-
-                    annotation_id += 1
-            image_id += 1
+# The images and annotations are streamed into per-split files as the sketches are processed
+coco_writer = CocoWriter(INFO, LICENSES, SPLITS)
 
 
+def process_textbox_sketch(json_data, sketch_name, measurement_masks=True, parcel_number_masks=True,
+                           coordinate_masks=True, year_masks=True):
+    """
+    Add the COCO image and annotation entries of one sketch to `coco_writer`, one image per vectorized attachment
+    with the annotations of the texts on it. The image ids are derived from the sketch and attachment names and the
+    annotation ids from those, the category and the index of the text, see `coco_writer.coco_id`. Returns the
+    entries, for `replay_textbox_sketch`.
+    """
+    # Directly attempt to extract image shape from JSON
+    # Initialize a list to store processed attachments
+    processed_attachments = []
+
+    for attachment, details in json_data['attachments'].items():
+        try:
+            # Check if 'vectorize' is present and True in the attachment's details
+            if details.get('properties', {}).get('vectorize',
+                                                 False):  # Check if vectorize is True in properties
+                properties = details['properties']
+
+                # Safely access 'dimensions' if it exists
+                dimensions = properties.get('dimensions', None)
+                if dimensions:
+                    height, width = dimensions[1], dimensions[
+                        0]  # Assuming dimensions[1] = height and dimensions[0] = width
+                    image_shape = (height, width)
+
+                    # Collect the processed attachment
+                    processed_attachments.append({
+                        "attachment": attachment,
+                        "image_shape": image_shape
+                    })
+                    logging.info(f"Processed {attachment}: {image_shape}")
+                else:
+                    logging.warning(f"Missing 'dimensions' for attachment {attachment}. Skipping...")
+            else:
+                logging.info(f"Skipping attachment {attachment} as vectorize is False.")
+        except KeyError as e:
+            logging.warning(f"Missing key {e} for attachment {attachment}. Skipping...")
+        except Exception as e:
+            logging.error(f"Unexpected error processing attachment {attachment}: {e}")
+        continue
+    # Log the collected processed attachments
+    logging.info(f"Processed Attachments: {processed_attachments}")
+    if not processed_attachments:
+        logging.warning(f"No vectorized attachment with dimensions in sketch {sketch_name}. Skipping...")
+        return
+
+    # Either the corner polygons or the rasterized masks of the text boxes
+    box_fn = generate_box_polygon if ANALYTIC_ANNOTATIONS else generate_box_mask
+    images, annotations = [], []
+    for processed_attachment in processed_attachments:
+        # Extract the attachment name and shape for each processed attachment
+        attachment = processed_attachment['attachment']
+        image_shape = processed_attachment['image_shape']
+
+        categories_to_instances = {}
+        if parcel_number_masks:
+            categories_to_instances['red_parcel'] = \
+                generate_parcel_mask_from_json(json_data, 'red', image_shape, box_fn, attachment)
+
+        if parcel_number_masks:
+            categories_to_instances['blue_parcel'] = \
+                generate_parcel_mask_from_json(json_data, 'blue', image_shape, box_fn, attachment)
+
+        if parcel_number_masks:
+            categories_to_instances['black_parcel'] = \
+                generate_parcel_mask_from_json(json_data, 'black', image_shape, box_fn, attachment)
+
+        if measurement_masks:
+            categories_to_instances['measurement'] = \
+                generate_mask_from_json(json_data, 'measurement', image_shape, box_fn, attachment)
+
+        if coordinate_masks:
+            categories_to_instances['coordinate'] = \
+                generate_mask_from_json(json_data, 'coordinate', image_shape, box_fn, attachment)
+
+        if year_masks:
+            categories_to_instances['year'] = \
+                generate_mask_from_json(json_data, 'year', image_shape, box_fn, attachment)
+
+        # Every attachment is an image of its own
+        image_id = coco_id(sketch_name, attachment)
+        # Construct the file name for the processed attachment
+        file_name = f'{sketch_name}.{attachment}.jpg'
+        # Create the COCO image info using the fixed target shape
+        image_info = pycococreatortools.create_image_info(
+            image_id, file_name, TARGET_SHAPE  # Use the predefined TARGET_SHAPE
+        )
+
+        # Append the created image info to the COCO output
+        images.append(image_info)
+
+        for category, masks in categories_to_instances.items():
+            categories[category] = CATEGORY_IDS[category]
+
+            class_id = categories[category]
+            category_info = {'id': class_id, 'is_crowd': False}
+            annotation_ids = [coco_id(sketch_name, attachment, category, index) for index in range(len(masks))]
+            if ANALYTIC_ANNOTATIONS:
+                annotation_infos = [pycococreatortools.create_polygon_annotation_info(
+                    annotation_id, image_id, category_info, polygon, TARGET_SHAPE)
+                    for annotation_id, polygon in zip(annotation_ids, masks)]
+            else:
+                # All masks of the category are encoded in bulk
+                annotation_infos = pycococreatortools.create_annotation_infos(
+                    annotation_ids, image_id, category_info, masks, tolerance=2)
+
+            for annotation_info in annotation_infos:
+                if annotation_info is not None:
+                    annotations.append(annotation_info)
+
+    # The sketch goes to the split picked by the hash of its name
+    payload = {'split': hash_split(sketch_name, SPLITS), 'images': images, 'annotations': annotations}
+    replay_textbox_sketch(payload)
+    return payload
+
+
+def replay_textbox_sketch(payload):
+    """
+    Add the entries returned by `process_textbox_sketch` to `coco_writer`, e.g. the ones an incremental run stored
+    for a sketch that did not change.
+    """
+    category_names = {category_id: name for name, category_id in CATEGORY_IDS.items()}
+    for annotation in payload['annotations']:
+        categories[category_names[annotation['category_id']]] = annotation['category_id']
+    coco_writer.add(payload['split'], payload['images'], payload['annotations'])
 
-if __name__ == '__main__':
-    logging.basicConfig(level=logging.INFO, format='%(asctime)s;%(levelname)s;%(message)s')
 
-    try:
-        response = s3_client.list_objects_v2(Bucket=S3_BUCKET_NAME, Prefix =f"{S3_MAIN_DIR}/{IN_DIR}")
-        if 'Contents' not in response:
-            logging.error(f"No contents found in the {S3_MAIN_DIR}")
-        else:
-            for obj in response.get('Contents', []):
-                    s3_key = obj['Key']
-                    if s3_key.endswith('.zip'): # Process only ZIP files
-                        logging.info(f"Processing ZIP files from S3: {s3_key}")
-                        try:
-                            read_zip(S3_BUCKET_NAME, s3_key)
-                            logging.info(f"Successfully processed ZIP file: {s3_key}")
-                        except Exception as e:
-                            logging.error(f"Failed to process zip file {s3_key}: {e}")
-    except Exception as e:
-        logging.error(f"Error listing or processing ZIP files from S3: {e}")
+def read_zip(s3_bucket, s3_key, measurement_masks=True, parcel_number_masks=True, coordinate_masks=True,
+             year_masks=True, manifest=None):
+    read_sketches(s3_bucket, s3_key, None, sketch_fn=partial(
+        process_textbox_sketch, measurement_masks=measurement_masks, parcel_number_masks=parcel_number_masks,
+        coordinate_masks=coordinate_masks, year_masks=year_masks), manifest=manifest,
+        replay_fn=replay_textbox_sketch)
 
-    coco_output['categories'] = [{
+
+def save_coco_splits(part=None):
+    """
+    Write the train/validate/test annotation files streamed by `coco_writer` and upload them to S3, or to the
+    partial dataset `part` that MERGE_COCO.py combines with the others.
+    """
+    coco_categories = [{
         'id': category_id,
         'name': category_name,
         'supercategory': 'sketch',
     } for category_name, category_id in categories.items()]
 
-    images_length = len(coco_output['images'])
-    train, validate, test = np.split(np.asarray(coco_output['images']), [
-        int(images_length * (TRAIN_SPLIT / 100)), int(images_length * ((TRAIN_SPLIT / 100) + (TEST_SPLIT / 100)))
-    ])
-
-    # Prepare output file paths in S3
-    train_key = f"{S3_MAIN_DIR}/{OUT_DIR}/train_annotations.json"
-    validate_key = f"{S3_MAIN_DIR}/{OUT_DIR}/validate_annotations.json"
-    test_key = f"{S3_MAIN_DIR}/{OUT_DIR}/test_annotations.json"
-
-    # Save JSON data directly to S3
-    s3_client.put_object(
-        Bucket=S3_BUCKET_NAME,
-        Key=train_key,
-        Body=json.dumps({**coco_output, 'images': train.tolist()})
-    )
-    logging.info(f"Train annotations saved to S3: {train_key}")
-
-    s3_client.put_object(
-        Bucket=S3_BUCKET_NAME,
-        Key=validate_key,
-        Body=json.dumps({**coco_output, 'images': validate.tolist()})
-    )
-    logging.info(f"Validate annotations saved to S3: {validate_key}")
-
-    s3_client.put_object(
-        Bucket=S3_BUCKET_NAME,
-        Key=test_key,
-        Body=json.dumps({**coco_output, 'images': test.tolist()})
-    )
-    logging.info(f"Test annotations saved to S3: {test_key}")
+    try:
+        paths = coco_writer.close(coco_categories)
+        for split, path in paths.items():
+            out_dir = OUT_DIR if part is None else f"{PARTIAL_DIR}/{part}"
+            s3_key = f"{S3_MAIN_DIR}/{out_dir}/{split}_annotations.json"
+            # upload_file switches to a concurrent multipart upload for large files
+            common.s3_client.upload_file(path, S3_BUCKET_NAME, s3_key, ExtraArgs={'ContentType': 'application/json'},
+                                         Config=TRANSFER_CONFIG)
+            logging.info(f"{split.capitalize()} annotations saved to S3: {s3_key}")
+    finally:
+        coco_writer.cleanup()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate the COCO textbox datasets from the vector-data ZIPs.")
+    common.add_render_arguments(parser)
+    common.add_zip_arguments(parser)
+    common.add_listing_arguments(parser)
+    args = common.check_zip_arguments(parser, add_annotation_arguments(parser).parse_args())
+    common.configure_rendering(args.direct_render, args.supersample, args.tile_threshold * 1_000_000)
+    configure_annotations(not args.raster_annotations)
+    common.configure_storage(args.storage)
+    common.configure_zip_access(args.zip_access, args.zip_memory_limit)
+    common.configure_rasters(args.export_rasters)
+    run_name = common.shard_name("textbox_generator", args)
+    log_file_path, file_handler = setup_logging(run_name)
+    manifest, completed = None, False
 
-    # Upload the log file to S3 after processing is done
     try:
-        s3_log_key=f"{S3_MAIN_DIR}/{S3_LOG_DIR}/textbox_generator.txt"
-        logging.info(f"Uploading log file to S3: {s3_log_key}")
-        
-        # Upload the log file to S3
-        with open(log_file_path, 'rb') as log_file:
-            s3_client.put_object(Body=log_file, Bucket=S3_BUCKET_NAME, Key=s3_log_key)
-        logging.info("log file uploaded successfully.")
-    
+        manifest = open_run_manifest(run_name, args)
+        # listing ZIP files in the S3 Bucket
+        zip_objects = list_zip_objects(S3_BUCKET_NAME, f"{S3_MAIN_DIR}/{IN_DIR}", workers=args.list_workers)
+        zip_objects = shard_zips(zip_objects, args.shard_index, args.shard_count)
+        if not zip_objects:
+            logging.error(f"No ZIP files found in {S3_MAIN_DIR}/{IN_DIR}")
+        else:
+            logging.info(f"Found {len(zip_objects)} ZIP files, {sum(obj['Size'] for obj in zip_objects)} bytes.")
+            # The split of an image follows from a hash of it, not from the order the ZIPs are processed in
+            zip_keys = schedule_zips(zip_objects, args.order)
+            if manifest is not None:
+                manifest.set_listing(zip_objects)
+            run_zips(S3_BUCKET_NAME, zip_keys, None, process_textbox_sketch, manifest=manifest,
+                     replay_fn=replay_textbox_sketch)
+        completed = True
     except Exception as e:
-        logging.error(f"Error uploading log file to S3: {e}")
-    
-    finally:
-        # Close the logging file handler
-        file_handler.close()
-        logging.getLogger().removeHandler(file_handler)
-        if os.path.exists(log_file_path):
-            os.remove(log_file_path)
-            logging.info("Cleaned up the local log file.")
+        logging.error(f"Error listing or processing ZIP files from S3: {e}")
 
+    save_coco_splits(coco_part(args))
+    # A journal is kept until the COCO files are saved, they are rebuilt from it on --resume
+    if manifest is not None:
+        manifest.close(completed)
 
+    # Upload the log file to S3 after processing is done
+    upload_log_file(log_file_path, file_handler, run_name)
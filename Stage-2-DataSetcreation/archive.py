@@ -0,0 +1,164 @@
+# archive.py
+import io
+import os
+import json
+import time
+import tarfile
+import logging
+import posixpath
+import tempfile
+import common
+from listing import list_objects
+from pipeline import WriteTracker
+from storage import TRANSFER_CONFIG
+from concurrent.futures import ThreadPoolExecutor
+
+S3_ARCHIVE_DIR = "retrain_data/archives"
+# Members are named by their output key below this directory, e.g. line/label/<sketch>.<attachment>.png
+S3_OUTPUT_ROOT = "retrain_data"
+INDEX_NAME = "index.json"
+
+
+def archive_prefix(name):
+    return f"{common.S3_MAIN_DIR}/{S3_ARCHIVE_DIR}/{name}"
+
+
+def index_key_of(member):
+    """`<sketch>.<attachment>` of an archive member."""
+    return posixpath.splitext(posixpath.basename(member))[0]
+
+
+class ArchiveWriter(WriteTracker):
+    """
+    Pack the outputs of a run into tar archives of about `max_size` bytes below `prefix`, instead of uploading one
+    object per output. `add` has the signature of an output sink, see `common.set_output_sink`.
+
+    An archive is written to a temporary file and uploaded in the background while the next one is filled. Next to
+    every archive `<archive>.json` lists its members with the offset and size of their data, so a member can be read
+    with one ranged GET. `close` merges these into INDEX_NAME, which maps `<sketch>.<attachment>` to
+    `{member: {"archive", "offset", "size"}}`. Archive names start with the start time of the run, so the archives of
+    a resumed run do not overwrite those of the run before it and later archives win in the index.
+
+    The outputs of an archive count as written once the archive is uploaded, so a manifest records their sketches
+    only then, see `manifest.Manifest.writes`.
+    """
+    def __init__(self, s3_bucket, prefix, max_size):
+        super().__init__()
+        self.s3_bucket = s3_bucket
+        self.prefix = prefix
+        self.max_size = max_size
+        self.run_id = time.strftime('%Y%m%dT%H%M%S')
+        self.count = 0
+        self.added = 0
+        self.file = None
+        self.tar = None
+        # Output keys of the archive being written
+        self.keys = []
+        # One archive is uploaded while the next one is written
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='archive')
+        self.upload = None
+
+    def _open(self):
+        self.file = tempfile.NamedTemporaryFile(suffix='.tar', delete=False)
+        self.tar = tarfile.open(fileobj=self.file, mode='w')
+
+    def add(self, s3_bucket, s3_key, body, content_type=None):
+        root = f"{common.S3_MAIN_DIR}/{S3_OUTPUT_ROOT}/"
+        name = s3_key[len(root):] if s3_key.startswith(root) else s3_key
+        if self.tar is not None and self.tar.offset and self.tar.offset + len(body) > self.max_size:
+            self.flush(wait=False)
+        if self.tar is None:
+            self._open()
+        info = tarfile.TarInfo(name)
+        info.size = len(body)
+        info.mtime = time.time()
+        self._started([s3_key])
+        self.tar.addfile(info, io.BytesIO(body))
+        self.keys.append(s3_key)
+        self.added += 1
+
+    def flush(self, wait=True):
+        """
+        Close the archive being written and start its upload. With `wait`, also wait until it is uploaded.
+        """
+        if self.tar is not None:
+            self.tar.close()
+            self.file.close()
+            archive_name = f"{self.run_id}-{self.count:05d}.tar"
+            self.count += 1
+            self.tar, path = None, self.file.name
+            keys, self.keys = self.keys, []
+            # Wait for the previous upload, so no more than two archives are on disk
+            self._wait()
+            self.upload = self.executor.submit(self._upload, path, archive_name, keys)
+        if wait:
+            self._wait()
+
+    def _wait(self):
+        if self.upload is not None:
+            upload, self.upload = self.upload, None
+            upload.result()
+
+    def _upload(self, path, archive_name, keys):
+        s3_key = f"{self.prefix}/{archive_name}"
+        try:
+            with tarfile.open(path) as tar:
+                members = [{'name': member.name, 'offset': member.offset_data, 'size': member.size}
+                           for member in tar]
+            common.s3_client.upload_file(path, self.s3_bucket, s3_key, ExtraArgs={'ContentType': 'application/x-tar'},
+                                         Config=TRANSFER_CONFIG)
+            common.s3_client.put_object(Bucket=self.s3_bucket, Key=f"{s3_key}.json", Body=json.dumps(members),
+                                        ContentType='application/json')
+            logging.info(f"Uploaded archive with {len(members)} outputs to S3: s3://{self.s3_bucket}/{s3_key}")
+            self._finished(keys)
+        except Exception as e:
+            logging.error(f"Error uploading archive s3://{self.s3_bucket}/{s3_key}: {e}")
+            self._finished(keys, failed=True)
+        finally:
+            os.remove(path)
+
+    def write_index(self):
+        """
+        Merge the member lists of all archives below the prefix into INDEX_NAME.
+        """
+        index = {}
+        for obj in list_objects(self.s3_bucket, f"{self.prefix}/", suffix='.tar.json'):
+            archive_name = posixpath.basename(obj['Key'])[:-len('.json')]
+            members = json.loads(common.s3_client.get_object(Bucket=self.s3_bucket, Key=obj['Key'])['Body'].read())
+            for member in members:
+                index.setdefault(index_key_of(member['name']), {})[member['name']] = {
+                    'archive': archive_name, 'offset': member['offset'], 'size': member['size']}
+        s3_key = f"{self.prefix}/{INDEX_NAME}"
+        common.s3_client.put_object(Bucket=self.s3_bucket, Key=s3_key, Body=json.dumps(index, sort_keys=True),
+                                    ContentType='application/json')
+        logging.info(f"Archive index of {len(index)} attachments saved to S3: {s3_key}")
+
+    def close(self, completed):
+        """
+        Upload the last archive, and when the run completed write the index.
+        """
+        try:
+            self.flush()
+            logging.info(f"Packed {self.added} outputs into {self.count} archives below {self.prefix}")
+            if completed:
+                self.write_index()
+        finally:
+            self.executor.shutdown()
+
+
+def open_archive(name, args, s3_bucket=common.S3_BUCKET_NAME):
+    """
+    Return an `ArchiveWriter` for the run `name` when --archive-size is set, otherwise None. A run that does not
+    --resume starts over and deletes the archives of the previous run of the same name.
+    """
+    if not args.archive_size:
+        return None
+    prefix = archive_prefix(common.output_name(name, args))
+    if not args.resume:
+        stale = list_objects(s3_bucket, f"{prefix}/")
+        for obj in stale:
+            common.s3_client.delete_object(Bucket=s3_bucket, Key=obj['Key'])
+        if stale:
+            logging.info(f"Deleted {len(stale)} objects of the previous archives below {prefix}")
+    logging.info(f"Packing the outputs into archives of {args.archive_size} MiB below {prefix}")
+    return ArchiveWriter(s3_bucket, prefix, args.archive_size << 20)
@@ -0,0 +1,117 @@
+# coco_writer.py
+import os
+import json
+import hashlib
+import logging
+import tempfile
+
+
+def hash_split(key, splits):
+    """
+    Pick a split for `key` from a stable hash of it, with the given split name -> percentage shares. The same key
+    always lands in the same split, whatever order or process it is processed in.
+    """
+    # Position of the key in [0, 100), uniform over the keys
+    position = int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big') * 100 / 2 ** 64
+    total = sum(splits.values())
+    for name, percentage in splits.items():
+        position -= percentage * 100 / total
+        if position < 0:
+            return name
+    return name
+
+
+def coco_id(*key):
+    """
+    Derive a COCO id from a stable key, e.g. the sketch name and the index of an instance. Ids derived this way do
+    not depend on processing order, so partial datasets built by different processes merge without collisions.
+    The id fits in 53 bits, so JSON readers that parse numbers as doubles keep it exact.
+    """
+    digest = hashlib.md5('/'.join(str(part) for part in key).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') >> 11
+
+
+class CocoWriter:
+    """
+    Stream a COCO dataset into one JSON file per split. Every `add` appends a group of images, together with their
+    annotations, to the scratch files of a split, so neither the dataset nor the other splits' annotations are held
+    in memory. `close` assembles the final files.
+    """
+    def __init__(self, info, licenses, splits, directory=None):
+        self.info = info
+        self.licenses = licenses
+        # Split name -> percentage of the images
+        self.splits = splits
+        self.directory = directory
+        self.scratch_dir = None
+        self.files = {}
+        self.counts = {name: {'images': 0, 'annotations': 0} for name in splits}
+
+    def _scratch_file(self, split, section):
+        if self.scratch_dir is None:
+            self.scratch_dir = tempfile.TemporaryDirectory(prefix='coco_')
+        if (split, section) not in self.files:
+            self.files[split, section] = open(os.path.join(self.scratch_dir.name, f'{split}.{section}'), 'w+')
+        return self.files[split, section]
+
+    def _append(self, split, section, items):
+        scratch_file = self._scratch_file(split, section)
+        for item in items:
+            if self.counts[split][section]:
+                scratch_file.write(', ')
+            scratch_file.write(json.dumps(item))
+            self.counts[split][section] += 1
+
+    def add(self, split, images, annotations):
+        """Append the images and their annotations to `split`."""
+        self._append(split, 'images', images)
+        self._append(split, 'annotations', annotations)
+
+    def _copy_section(self, split, section, out_file):
+        scratch_file = self.files.get((split, section))
+        if scratch_file is None:
+            return
+        scratch_file.seek(0)
+        while True:
+            chunk = scratch_file.read(1 << 20)
+            if not chunk:
+                break
+            out_file.write(chunk)
+
+    def close(self, categories):
+        """
+        Write the `<split>_annotations.json` files into `directory` (a temporary directory by default) and return
+        a dict of split name -> file path. The files have the same layout as a `json.dumps` of the whole dataset.
+        """
+        if self.directory is None:
+            if self.scratch_dir is None:
+                self.scratch_dir = tempfile.TemporaryDirectory(prefix='coco_')
+            self.directory = self.scratch_dir.name
+        os.makedirs(self.directory, exist_ok=True)
+
+        paths = {}
+        for split in self.splits:
+            paths[split] = os.path.join(self.directory, f'{split}_annotations.json')
+            with open(paths[split], 'w') as out_file:
+                out_file.write(f'{{"info": {json.dumps(self.info)}, "images": [')
+                self._copy_section(split, 'images', out_file)
+                out_file.write('], "annotations": [')
+                self._copy_section(split, 'annotations', out_file)
+                out_file.write(f'], "licenses": {json.dumps(self.licenses)}, '
+                               f'"categories": {json.dumps(categories)}}}')
+            logging.info(f"Wrote {self.counts[split]['images']} images and {self.counts[split]['annotations']} "
+                         f"annotations to {paths[split]}")
+
+        for scratch_file in self.files.values():
+            scratch_file.close()
+        self.files = {}
+        return paths
+
+    def cleanup(self):
+        """Remove the scratch files, and the output files if they were written to the temporary directory."""
+        for scratch_file in self.files.values():
+            scratch_file.close()
+        self.files = {}
+        if self.scratch_dir is not None:
+            self.scratch_dir.cleanup()
+            self.scratch_dir = None
@@ -1,22 +1,165 @@
 # common.py
+import io
+import os
 import cv2
 import json
+import argparse
 import zipfile
 import logging
 import numpy as np
-import boto3
-from io import BytesIO
+from functools import partial
+from PIL import Image
+from tempfile import gettempdir
+from zip_reader import open_zip, download_zip
+from storage import create_client, SkipUnchanged, TRANSFER_CONFIG
 
 TARGET_SHAPE = (1664, 1024)
 THICKNESS = 8
 
+# Render straight into TARGET_SHAPE instead of drawing at the attachment resolution and resizing, see
+# `configure_rendering`. SUPERSAMPLE draws on a canvas that many times larger than TARGET_SHAPE first.
+RENDER_DIRECT = False
+SUPERSAMPLE = 1
+# Whether `generate_polyline_mask` has logged that it fell back from direct rendering, which it does once per process
+_direct_fallback_logged = False
+# Fractional bits of the fixed-point coordinates passed to the cv2 drawing functions
+DRAW_SHIFT = 4
+# When set, attachments of more pixels than this are not drawn on one full resolution canvas but in tiles of at most
+# about TILE_SIZE x TILE_SIZE pixels, so the memory used does not grow with the attachment, see `render_tiled`. The
+# tiled masks are approximate, so this is off (0) by default
+TILE_THRESHOLD = 0
+TILE_SIZE = 4096
+# Fractional bits of the cv2.resize INTER_LINEAR weights, which `render_tiled` reproduces
+RESIZE_COEF_BITS = 11
+
+# How `fetch_zip` opens the project ZIPs: 'ranged' reads only the central directory and the sketch snapshots with
+# HTTP Range requests, 'full' downloads the whole archive. Full downloads larger than ZIP_MEMORY_LIMIT bytes are
+# spilled to a memory-mapped temporary file. See `configure_zip_access`.
+ZIP_ACCESS = 'ranged'
+ZIP_MEMORY_LIMIT = 256 << 20
+SKETCH_PREFIX, SKETCH_POSTFIX = 'observations/snapshots/latest/', '.latest.json'
+
+# Encoding of the label masks, see `encode_label`: file extension and content type per format
+LABEL_FORMATS = {
+    'png': ('.png', 'image/png'),
+    'png1': ('.png', 'image/png'),
+    'npy': ('.npy', 'application/octet-stream'),
+}
+LABEL_FORMAT = 'png'
+# zlib level 0-9 of the PNG labels, None for the encoder's default
+PNG_COMPRESSION = None
+# Order of the products in the channels of a combined label
+LABEL_CHANNELS = ('line', 'building', 'border')
+
+# Also export the raster of every vectorized attachment, resized to TARGET_SHAPE, see `configure_rasters`. The
+# rasters are the ZIP members named after their attachment, `<...>/<attachment>.<extension>`.
+EXPORT_RASTERS = False
+RASTER_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff')
+RASTER_JPEG_QUALITY = 95
+# Named <sketch>.<attachment>.jpg, as the image entries of the textbox COCO files
+RASTER_SUB_DIR = "retrain_data/images"
+
 S3_BUCKET_NAME = "kadaster-magnasoft"
 S3_MAIN_DIR = "Kadaster-AI-ML"
 IN_DIR = "vector-data"
 S3_LOG_DIR = "logs/datasetcreation"
 
+# Where the objects are read from and written to, see `configure_storage`
+STORAGE_URL = None
+
+s3_client = create_client()
+
+
+def setup_logging(log_name):
+    """
+    Log to the console and to a local file that is uploaded to S3 with `upload_log_file` at the end of the run.
+    """
+    # Get a cross-platform temporary directory (e.g., /tmp on Linux, C:\Temp on Windows) and define log file path
+    log_file_path = os.path.join(gettempdir(), f"{log_name}.log")
+    os.makedirs(os.path.dirname(log_file_path), exist_ok=True)
+    file_handler = logging.FileHandler(log_file_path)
+    stream_handler = logging.StreamHandler()
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s;%(levelname)s;%(message)s',
+        handlers=[file_handler, stream_handler]
+    )
+    return log_file_path, file_handler
+
+
+def upload_log_file(log_file_path, file_handler, log_name):
+    """
+    Upload the local log file to S3 and remove it afterwards.
+    """
+    try:
+        s3_log_key = f"{S3_MAIN_DIR}/{S3_LOG_DIR}/{log_name}.txt"
+        logging.info(f"Uploading log file to S3: {s3_log_key}")
+
+        # Upload the log file to S3
+        s3_client.upload_file(log_file_path, S3_BUCKET_NAME, s3_log_key, Config=TRANSFER_CONFIG)
+        logging.info("log file uploaded successfully.")
+
+    except Exception as e:
+        logging.error(f"Error uploading log file to S3: {e}")
+
+    finally:
+        # Close the logging file handler
+        file_handler.close()
+        logging.getLogger().removeHandler(file_handler)
+        if os.path.exists(log_file_path):
+            os.remove(log_file_path)
+            logging.info("Cleaned up the local log file.")
+
+
+# When set, outputs are handed to this callable instead of being uploaded right away, see `set_output_sink`
+_output_sink = None
+
+
+def set_output_sink(sink):
+    """
+    Route `write_output` calls to `sink(s3_bucket, s3_key, body, content_type)`, or back to S3 when None.
+    """
+    global _output_sink
+    _output_sink = sink
+
+
+def get_output_sink():
+    return _output_sink
+
+
+# With `configure_uploads(skip_unchanged=True)` a `storage.SkipUnchanged` that outputs are uploaded through
+upload_filter = None
+
+
+def configure_uploads(skip_unchanged=False):
+    global upload_filter
+    upload_filter = SkipUnchanged() if skip_unchanged else None
+
+
+def put_output(s3_bucket, s3_key, body, content_type):
+    """
+    Upload an output and return whether it was uploaded, False when `upload_filter` found it unchanged.
+    """
+    if upload_filter is None:
+        s3_client.put_object(Bucket=s3_bucket, Key=s3_key, Body=body, ContentType=content_type)
+    elif not upload_filter.put_object(s3_client, Bucket=s3_bucket, Key=s3_key, Body=body, ContentType=content_type):
+        logging.info(f"Unchanged on S3, not uploaded: s3://{s3_bucket}/{s3_key}")
+        return False
+    logging.info(f"Uploaded to S3: s3://{s3_bucket}/{s3_key}")
+    return True
+
+
+def write_output(s3_bucket, s3_key, body, content_type):
+    if _output_sink is not None:
+        _output_sink(s3_bucket, s3_key, body, content_type)
+    else:
+        put_output(s3_bucket, s3_key, body, content_type)
+
+
+def delete_output(s3_bucket, s3_key):
+    s3_client.delete_object(Bucket=s3_bucket, Key=s3_key)
+    logging.info(f"Deleted from S3: s3://{s3_bucket}/{s3_key}")
 
-s3_client = boto3.client('s3')
 
 def upload_image_to_s3(image, s3_bucket, s3_key):
     """
@@ -25,46 +168,696 @@ def upload_image_to_s3(image, s3_bucket, s3_key):
     try:
         # Encode image to PNG format in memory
         _, buffer = cv2.imencode('.png', image)
-        s3_client.put_object(Bucket=s3_bucket, Key=s3_key, Body=BytesIO(buffer), ContentType='image/png')
-        logging.info(f"Uploaded to S3: s3://{s3_bucket}/{s3_key}")
+        write_output(s3_bucket, s3_key, buffer.tobytes(), 'image/png')
     except Exception as e:
         logging.error(f"Error uploading image to S3: {e}")
 
-def generate_line_mask(lines, mask_shape):
+
+def label_key(sub_dir, sketch_name, attachment):
+    return f"{S3_MAIN_DIR}/{sub_dir}/{sketch_name}.{attachment}{LABEL_FORMATS[LABEL_FORMAT][0]}"
+
+
+def encode_label(masks):
+    """
+    Encode a label, a boolean TARGET_SHAPE mask or a list of them as channels (None for an empty channel), in
+    LABEL_FORMAT. Returns the encoded bytes and their content type.
+
+    'png' writes the masks as 0/255 in an 8-bit PNG, with one channel per mask in the order cv2.imread returns
+    them. 'png1' writes a single mask as a 1-bit PNG. 'npy' saves the masks packed with np.packbits along the rows,
+    of shape (H, W / 8) or (channels, H, W / 8); `np.unpackbits(np.load(f), axis=-1).view(bool)` restores them.
+    """
+    channels = list(masks) if isinstance(masks, (list, tuple)) else [masks]
+    channels = [np.zeros(TARGET_SHAPE, dtype=bool) if mask is None else mask for mask in channels]
+    content_type = LABEL_FORMATS[LABEL_FORMAT][1]
+    if LABEL_FORMAT == 'npy':
+        buffer = io.BytesIO()
+        np.save(buffer, np.packbits(np.stack(channels) if len(channels) > 1 else channels[0], axis=-1))
+        return buffer.getvalue(), content_type
+
+    if LABEL_FORMAT == 'png1':
+        if len(channels) > 1:
+            raise ValueError("1-bit PNG labels have a single channel")
+        height, width = channels[0].shape
+        image = Image.frombytes('1', (width, height), np.packbits(channels[0], axis=-1).tobytes())
+        buffer = io.BytesIO()
+        image.save(buffer, 'PNG', **({} if PNG_COMPRESSION is None else {'compress_level': PNG_COMPRESSION}))
+        return buffer.getvalue(), content_type
+
+    if len(channels) > 1:
+        image = np.dstack([mask.view(np.uint8) for mask in channels]) * np.uint8(255)
+    else:
+        image = get_masked(channels[0], None, None, TARGET_SHAPE)
+    params = [] if PNG_COMPRESSION is None else [cv2.IMWRITE_PNG_COMPRESSION, PNG_COMPRESSION]
+    _, buffer = cv2.imencode('.png', image, params)
+    return buffer.tobytes(), content_type
+
+
+def write_label(masks, sub_dir, sketch_name, attachment):
+    """
+    Encode a label with `encode_label` and write it below `sub_dir` as `<sketch>.<attachment>`. Returns the key. A
+    failed upload raises, so the sketch is not recorded as done.
+    """
+    s3_key = label_key(sub_dir, sketch_name, attachment)
+    try:
+        body, content_type = encode_label(masks)
+        write_output(S3_BUCKET_NAME, s3_key, body, content_type)
+        return s3_key
+    except Exception as e:
+        logging.error(f"Error uploading label to S3: {s3_key}: {e}")
+        raise
+
+
+def configure_output(label_format='png', png_compression=None):
+    global LABEL_FORMAT, PNG_COMPRESSION
+    LABEL_FORMAT, PNG_COMPRESSION = label_format, png_compression
+
+
+def get_output_options():
+    return {'label_format': LABEL_FORMAT, 'png_compression': PNG_COMPRESSION}
+
+
+def configure_rasters(export=False):
+    global EXPORT_RASTERS
+    EXPORT_RASTERS = export
+
+
+def configure_rendering(direct=False, supersample=1, tile_threshold=TILE_THRESHOLD):
+    global RENDER_DIRECT, SUPERSAMPLE, TILE_THRESHOLD
+    RENDER_DIRECT, SUPERSAMPLE, TILE_THRESHOLD = direct, max(1, supersample), tile_threshold
+
+
+def get_render_options():
+    return {'direct': RENDER_DIRECT, 'supersample': SUPERSAMPLE, 'tile_threshold': TILE_THRESHOLD}
+
+
+def configure_storage(url=None, pool_connections=None):
+    """
+    Switch `s3_client` to the storage at `url`, see `storage.create_client`, with a connection pool for
+    `pool_connections` concurrent requests.
+    """
+    global STORAGE_URL, s3_client
+    STORAGE_URL = url
+    s3_client = create_client(url) if pool_connections is None else create_client(url, pool_connections)
+
+
+def connection_pool_size(args):
+    """
+    Requests a run can have in flight on `s3_client` at once: the uploads and prefetched ZIPs of pipeline mode,
+    the listing threads and the main thread.
+    """
+    size = getattr(args, 'list_workers', 1) + 1
+    if getattr(args, 'pipeline', False):
+        size += args.upload_workers + args.prefetch
+    return size
+
+
+def configure_zip_access(access='ranged', memory_limit_mb=256):
+    global ZIP_ACCESS, ZIP_MEMORY_LIMIT
+    ZIP_ACCESS, ZIP_MEMORY_LIMIT = access, memory_limit_mb << 20
+
+
+def to_target_space(points, mask_shape, canvas_shape=None):
+    """
+    Map (x, y) positions of an attachment of `mask_shape` onto a canvas of `canvas_shape`, by default the
+    (supersampled) TARGET_SHAPE, using the same pixel-center convention as cv2.resize. Returns fixed-point
+    coordinates for the cv2 drawing calls and the (x, y) scale.
+    """
+    if canvas_shape is None:
+        canvas_shape = (TARGET_SHAPE[0] * SUPERSAMPLE, TARGET_SHAPE[1] * SUPERSAMPLE)
+    scale = np.array([canvas_shape[1] / mask_shape[1], canvas_shape[0] / mask_shape[0]])
+    points = (np.asarray(points, dtype=np.float64) + 0.5) * scale - 0.5
+    return np.round(points * (1 << DRAW_SHIFT)).astype(np.int32), scale
+
+
+def isotropic_canvas_shape(mask_shape):
+    """
+    The (supersampled) TARGET_SHAPE canvas, stretched along the axis the attachment is shrunk more along, so that
+    the attachment maps onto it with the same scale in x and y.
+    """
+    scale = max(TARGET_SHAPE[0] / mask_shape[0], TARGET_SHAPE[1] / mask_shape[1]) * SUPERSAMPLE
+    return (max(TARGET_SHAPE[0] * SUPERSAMPLE, int(round(mask_shape[0] * scale))),
+            max(TARGET_SHAPE[1] * SUPERSAMPLE, int(round(mask_shape[1] * scale))))
+
+
+def _finish_target_canvas(canvas, threshold):
+    if SUPERSAMPLE > 1:
+        canvas = cv2.resize(canvas, (TARGET_SHAPE[1], TARGET_SHAPE[0]), interpolation=cv2.INTER_AREA)
+    return canvas >= threshold
+
+
+def render_polylines_at_target(polylines, mask_shape):
+    """
+    Draw polylines given in attachment coordinates directly at TARGET_SHAPE, with THICKNESS scaled along.
+
+    A single pen width cannot follow a resize that scales x and y differently, so the polylines are drawn on an
+    `isotropic_canvas_shape` canvas and sampled down to TARGET_SHAPE with INTER_NEAREST_EXACT, the way the bilinear
+    resize samples the full resolution mask.
+    """
+    target_shape = (TARGET_SHAPE[0] * SUPERSAMPLE, TARGET_SHAPE[1] * SUPERSAMPLE)
+    canvas = np.zeros(isotropic_canvas_shape(mask_shape) if polylines else target_shape, dtype=np.uint8)
+    if polylines:
+        points, scale = to_target_space(np.concatenate(polylines), mask_shape, canvas.shape)
+        thickness = max(1, int(round(THICKNESS * scale.mean())))
+        cv2.polylines(canvas, _split_polylines(points, polylines), False, 255, thickness=thickness,
+                      lineType=cv2.LINE_8, shift=DRAW_SHIFT)
+        if canvas.shape != target_shape:
+            canvas = cv2.resize(canvas, (target_shape[1], target_shape[0]), interpolation=cv2.INTER_NEAREST_EXACT)
+    # Any coverage lights a pixel, like the bilinear resize of the full resolution mask does
+    return _finish_target_canvas(canvas, 1)
+
+
+def render_polygon_at_target(points, mask_shape):
+    """
+    Fill a convex polygon given in attachment coordinates directly at TARGET_SHAPE.
+    """
+    canvas = np.zeros((TARGET_SHAPE[0] * SUPERSAMPLE, TARGET_SHAPE[1] * SUPERSAMPLE), dtype=np.uint8)
+    polygon, _ = to_target_space(points, mask_shape)
+    cv2.fillConvexPoly(canvas, polygon, 255, lineType=cv2.LINE_8, shift=DRAW_SHIFT)
+    # Pixels at least half covered belong to the polygon
+    return _finish_target_canvas(canvas, 128)
+
+
+def _linear_taps(src_size, dst_size):
+    """
+    The two source pixels and fixed-point weights cv2.resize INTER_LINEAR reads for every target pixel along one
+    axis, computed as OpenCV does, clamped at the borders.
+    """
+    scale = 1.0 / (dst_size / src_size)
+    position = ((np.arange(dst_size) + 0.5) * scale - 0.5).astype(np.float32)
+    first = np.floor(position).astype(np.int32)
+    fraction = position - first
+    outside = (first < 0) | (first >= src_size - 1)
+    first = np.clip(first, 0, src_size - 1)
+    fraction[outside] = 0
+    weight = np.rint(fraction * np.float32(1 << RESIZE_COEF_BITS)).astype(np.int32)
+    return first, np.minimum(first + 1, src_size - 1), (1 << RESIZE_COEF_BITS) - weight, weight
+
+
+def _resize_tile(canvas, rows, cols):
+    """
+    Resample `canvas` at the given taps with the integer arithmetic of OpenCV's vectorized 8-bit linear resize.
+    """
+    row0, row1, beta0, beta1 = rows
+    col0, col1, alpha0, alpha1 = cols
+    horizontal = canvas[:, col0].astype(np.int32) * alpha0 + canvas[:, col1].astype(np.int32) * alpha1
+    vertical = (((horizontal[row0] >> 4) * beta0[:, None]) >> 16) + (((horizontal[row1] >> 4) * beta1[:, None]) >> 16)
+    return np.minimum((vertical + 2) >> 2, 255).astype(np.uint8)
+
+
+def render_tiled(draw, mask_shape, bounds=None):
+    """
+    Return what `draw(canvas, x0, y0)` draws on a `mask_shape` canvas resized to TARGET_SHAPE with INTER_LINEAR,
+    without allocating that canvas. The target is split into tiles, and for each tile `draw` gets a canvas holding
+    only the attachment pixels the tile reads, with its origin at (x0, y0). Tiles outside the
+    (x_min, y_min, x_max, y_max) `bounds` of the drawing are skipped.
+
+    The tiles are resampled bit for bit as cv2.resize would resample the full canvas. cv2 clips thick lines to the
+    canvas with its own fixed-point rounding though, so the pixels around tile borders differ from a full canvas
+    drawing and the mask is only an approximation of it; for lines a few percent of the mask pixels differ.
+    """
+    height, width = mask_shape
+    row_taps, col_taps = _linear_taps(height, TARGET_SHAPE[0]), _linear_taps(width, TARGET_SHAPE[1])
+    step_y = max(1, int((TILE_SIZE - 1) * TARGET_SHAPE[0] / height))
+    step_x = max(1, int((TILE_SIZE - 1) * TARGET_SHAPE[1] / width))
+    target = np.zeros(TARGET_SHAPE, dtype=np.uint8)
+    for ty in range(0, TARGET_SHAPE[0], step_y):
+        rows = [taps[ty:ty + step_y] for taps in row_taps]
+        y0, y1 = rows[0][0], rows[1][-1] + 1
+        if bounds is not None and (y1 <= bounds[1] or y0 > bounds[3]):
+            continue
+        for tx in range(0, TARGET_SHAPE[1], step_x):
+            cols = [taps[tx:tx + step_x] for taps in col_taps]
+            x0, x1 = cols[0][0], cols[1][-1] + 1
+            if bounds is not None and (x1 <= bounds[0] or x0 > bounds[2]):
+                continue
+            canvas = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+            draw(canvas, x0, y0)
+            if canvas.any():
+                target[ty:ty + step_y, tx:tx + step_x] = _resize_tile(
+                    canvas, (rows[0] - y0, rows[1] - y0, *rows[2:]), (cols[0] - x0, cols[1] - x0, *cols[2:]))
+    return target
+
+
+def use_tiles(mask_shape):
+    """
+    Whether an attachment of `mask_shape` is drawn with `render_tiled`, see TILE_THRESHOLD.
+    """
+    return bool(TILE_THRESHOLD) and mask_shape[0] * mask_shape[1] > TILE_THRESHOLD
+
+
+def render_polylines_tiled(polylines, mask_shape):
+    """
+    Draw polylines given as int32 attachment coordinates with `render_tiled`, each tile only the ones that reach it.
+    """
+    lows = np.array([polyline.min(axis=0) for polyline in polylines]) - THICKNESS
+    highs = np.array([polyline.max(axis=0) for polyline in polylines]) + THICKNESS
+
+    def draw(canvas, x0, y0):
+        height, width = canvas.shape
+        near = np.flatnonzero((highs[:, 0] >= x0) & (lows[:, 0] < x0 + width) &
+                              (highs[:, 1] >= y0) & (lows[:, 1] < y0 + height))
+        if len(near):
+            cv2.polylines(canvas, [polylines[i] - (x0, y0) for i in near], False, 255, thickness=THICKNESS,
+                          lineType=cv2.LINE_8)
+
+    return render_tiled(draw, mask_shape, (*lows.min(axis=0), *highs.max(axis=0)))
+
+
+def _split_polylines(points, polylines):
+    """
+    Split the concatenated `points` of `polylines` back into one array per polyline.
+    """
+    return np.split(points, np.cumsum([len(polyline) for polyline in polylines])[:-1])
+
+
+def generate_polyline_mask(polylines, mask_shape):
+    """
+    Render (N, 2) arrays of attachment coordinates as open polylines into a boolean TARGET_SHAPE mask, or
+    return None when nothing was drawn. All polylines are drawn with a single cv2.polylines call, or tile by tile
+    for attachments of more than a set TILE_THRESHOLD pixels.
+    """
+    global _direct_fallback_logged
+    polylines = [polyline for polyline in polylines if len(polyline) > 1]
+    if RENDER_DIRECT:
+        canvas_shape = isotropic_canvas_shape(mask_shape)
+        # An isotropic canvas larger than the attachment itself saves nothing over drawing at full resolution
+        if np.prod(canvas_shape) <= mask_shape[0] * mask_shape[1]:
+            mask = render_polylines_at_target(polylines, mask_shape)
+            return mask if mask.any() else None
+        if not _direct_fallback_logged:
+            logging.info(f"Attachments smaller than the {canvas_shape[0]}x{canvas_shape[1]} canvas of "
+                         f"--direct-render --supersample {SUPERSAMPLE}, like this {mask_shape[0]}x{mask_shape[1]} "
+                         f"one, are drawn at full resolution instead.")
+            _direct_fallback_logged = True
+
+    if not polylines:
+        return None
+    points = np.concatenate(polylines).astype(np.int32)
+    if use_tiles(mask_shape):
+        mask = render_polylines_tiled(_split_polylines(points, polylines), mask_shape) > 0
+        return mask if mask.any() else None
+
     mask = np.zeros(mask_shape, dtype=np.uint8)
-    for line in lines:
-        cv2.line(mask, (int(line[0][0]), int(line[0][1])), (int(line[1][0]), int(line[1][1])), 255,
-                 thickness=THICKNESS, lineType=cv2.LINE_8)
-    mask = cv2.resize(mask, (TARGET_SHAPE[1], TARGET_SHAPE[0])).astype(np.uint8)
-    return np.nonzero(mask) if np.any(mask) else None
+    cv2.polylines(mask, _split_polylines(points, polylines), False, 255, thickness=THICKNESS, lineType=cv2.LINE_8)
+    mask = cv2.resize(mask, (TARGET_SHAPE[1], TARGET_SHAPE[0])) > 0
+    return mask if mask.any() else None
+
+
+def generate_line_mask(lines, mask_shape):
+    """
+    Render line segments into a boolean TARGET_SHAPE mask, or None when nothing was drawn.
+    """
+    return generate_polyline_mask(list(np.reshape(np.asarray(lines, dtype=np.float64), (-1, 2, 2))), mask_shape)
+
+
+# Preprocessed data of the last sketch passed to the functions below, see `_sketch_cache_for`
+_sketch_cache = {'obs': None}
+
+
+def _sketch_cache_for(obs):
+    """
+    Return the preprocessing cache of `obs`. All products rendering the same parsed sketch share it.
+    """
+    global _sketch_cache
+    if _sketch_cache['obs'] is not obs:
+        _sketch_cache = {'obs': obs}
+    return _sketch_cache
+
+
+def get_sketch_cached(obs, key, build):
+    """
+    Return `build(obs)`, computed only once per parsed sketch.
+    """
+    cache = _sketch_cache_for(obs)
+    if key not in cache:
+        cache[key] = build(obs)
+    return cache[key]
+
+
+def get_point_index(obs):
+    """
+    Return the point positions of a sketch as an (N, 2) array and a map from point id to row.
+    """
+    cache = _sketch_cache_for(obs)
+    if 'points' not in cache:
+        points = obs['points']
+        rows = {point_id: row for row, point_id in enumerate(points)}
+        positions = np.array([point['position'] for point in points.values()], dtype=np.float64).reshape(-1, 2)
+        cache['points'] = rows, positions
+    return cache['points']
+
+
+def group_by_attachment(obs, feature_type):
+    """
+    Group the features of one type (e.g. 'lines' or 'buildings') of a sketch by attachment in a single pass.
+    """
+    cache = _sketch_cache_for(obs)
+    if feature_type not in cache:
+        groups = {}
+        for feature in obs.get(feature_type, {}).values():
+            groups.setdefault(feature.get('attachment'), []).append(feature)
+        cache[feature_type] = groups
+    return cache[feature_type]
+
+
+def point_polylines(obs, point_id_lists):
+    """
+    Turn lists of point ids into (N, 2) coordinate arrays with one vectorized gather.
+    """
+    if not point_id_lists:
+        return []
+    rows, positions = get_point_index(obs)
+    point_rows = np.fromiter((rows[point_id] for point_ids in point_id_lists for point_id in point_ids),
+                             dtype=np.intp)
+    return _split_polylines(positions[point_rows], point_id_lists)
+
+
+def attachment_polylines(obs, feature_type, attachment):
+    """
+    Return the coordinate arrays of all features of one type drawn on `attachment`.
+    """
+    features = group_by_attachment(obs, feature_type).get(attachment, [])
+    return point_polylines(obs, [feature['points'] for feature in features])
 
 
 def get_masked(line_masks, building_masks, border_masks, mask_shape):
+    """
+    Combine boolean masks into one 0/255 image by OR-ing them into the output in place.
+    """
     mask_img = np.zeros(mask_shape, dtype=np.uint8)
-    if line_masks is not None:
-        mask_img[line_masks[0], line_masks[1]] = 255
-    if building_masks is not None:
-        mask_img[building_masks[0], building_masks[1]] = 255
-    if border_masks is not None:
-        mask_img[border_masks[0], border_masks[1]] = 255
+    for mask in (line_masks, building_masks, border_masks):
+        if mask is not None:
+            np.bitwise_or(mask_img, mask.view(np.uint8), out=mask_img)
+    mask_img *= 255
     return mask_img
 
 
-def read_zip(s3_bucket,s3_key, process_fn):
+def add_render_arguments(parser):
+    parser.add_argument('--direct-render', action='store_true',
+                        help="Draw masks directly at the target shape instead of resizing full resolution masks.")
+    parser.add_argument('--supersample', type=int, default=1,
+                        help="Supersampling factor for --direct-render. It only takes effect on attachments larger "
+                             "than the supersampled target, smaller ones are drawn at full resolution (default: 1).")
+    parser.add_argument('--tile-threshold', type=int, default=TILE_THRESHOLD // 1_000_000,
+                        help=f"Draw attachments larger than this many megapixels at full resolution in tiles of "
+                             f"{TILE_SIZE} pixels instead of on one canvas, keeping the memory bounded. The tiled "
+                             f"masks are approximate: pixels around the tile borders differ from those drawn on one "
+                             f"canvas, a few percent of a line mask (default: 0, no tiles).")
+    return parser
+
+
+def add_output_arguments(parser):
+    parser.add_argument('--label-format', choices=list(LABEL_FORMATS), default='png',
+                        help="Encoding of the label masks: 8-bit 'png', 1-bit 'png1', or 'npy' with the bits packed "
+                             "along the rows (default: png).")
+    parser.add_argument('--skip-unchanged', action='store_true',
+                        help="Do not upload outputs whose bytes equal the object already stored, comparing their MD5 "
+                             "with the ETags of one listing per output directory. The uploads then all happen in "
+                             "this process, so combine it with --pipeline.")
+    parser.add_argument('--png-compression', type=int, choices=range(10), default=None, metavar='0-9',
+                        help="zlib compression level of the PNG labels (default: the encoder's default).")
+    return parser
+
+
+def add_archive_arguments(parser):
+    parser.add_argument('--archive-size', type=int, default=0,
+                        help="Pack the outputs into tar archives of this many MiB with an index, instead of one object "
+                             "per output. The run journal records the sketches of an archive once it is uploaded "
+                             "(default: 0, no archives).")
+    return parser
+
+
+def add_storage_arguments(parser):
+    parser.add_argument('--storage', default=None,
+                        help="Storage to read the ZIPs from and write the outputs to: 's3', 'file://<directory>' for "
+                             "a local copy laid out as <directory>/<bucket>/<key>, or 'memory://' "
+                             "(default: $DATASET_STORAGE, or s3).")
+    return parser
+
+
+def add_zip_arguments(parser):
+    add_storage_arguments(parser)
+    parser.add_argument('--zip-access', choices=['ranged', 'full'], default='ranged',
+                        help="Read only the sketch snapshots of each ZIP with ranged requests, or download whole "
+                             "ZIPs (default: ranged).")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Only process the ZIPs and sketches that changed since the last incremental run, and "
+                             "delete the outputs of removed ones.")
+    parser.add_argument('--journal', action='store_true',
+                        help="Keep a journal of the sketches this run completed on S3 until the run completes, so "
+                             "that a run that dies can be continued with --resume.")
+    parser.add_argument('--resume', action='store_true',
+                        help="Continue the last --journal run that did not complete, skipping the sketches its "
+                             "journal records as done. The resumed run keeps the journal.")
+    parser.add_argument('--checkpoint-interval', type=float, default=60,
+                        help="Seconds between uploads of the run journal or incremental manifest (default: 60).")
+    parser.add_argument('--shard-index', type=int, default=0,
+                        help="Index of the ZIP shard processed by this node, in [0, --shard-count) (default: 0).")
+    parser.add_argument('--shard-count', type=int, default=1,
+                        help="Number of nodes the ZIPs are partitioned over. Incremental manifests are kept per "
+                             "shard, so keep the count fixed between incremental runs (default: 1).")
+    parser.add_argument('--export-rasters', action='store_true',
+                        help=f"Also write the raster of every vectorized attachment, resized to the label shape, to "
+                             f"{RASTER_SUB_DIR} as <sketch>.<attachment>.jpg.")
+    parser.add_argument('--zip-memory-limit', type=int, default=256,
+                        help="Whole ZIPs larger than this many MiB are downloaded to a memory-mapped temporary file "
+                             "instead of memory (default: 256).")
+    return parser
+
+
+def add_listing_arguments(parser):
+    parser.add_argument('--list-workers', type=int, default=1,
+                        help="Threads used to list the sub-prefixes of the input directory (default: 1).")
+    parser.add_argument('--order', choices=['largest-first', 'listing'], default='largest-first',
+                        help="Order in which the ZIPs are processed (default: largest-first).")
+    return parser
+
+
+def check_zip_arguments(parser, args):
+    """
+    Reject invalid options of `add_zip_arguments` with `parser.error`, before the run touches S3.
+    """
+    if args.shard_count < 1:
+        parser.error("--shard-count must be at least 1")
+    if not 0 <= args.shard_index < args.shard_count:
+        parser.error(f"--shard-index must be in [0, {args.shard_count}) for --shard-count {args.shard_count}")
+    return args
+
+
+def add_run_arguments(parser):
+    """
+    Add the command line options shared by all dataset creation scripts.
+    """
+    add_render_arguments(parser)
+    add_output_arguments(parser)
+    add_archive_arguments(parser)
+    add_zip_arguments(parser)
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Worker processes for the attachments of a ZIP (default: 1, 0: one per CPU).")
+    parser.add_argument('--pipeline', action='store_true',
+                        help="Download the next ZIPs and upload the outputs while the current ZIP is rendered.")
+    parser.add_argument('--prefetch', type=int, default=2,
+                        help="ZIPs downloaded ahead of the one being rendered in pipeline mode (default: 2).")
+    parser.add_argument('--upload-workers', type=int, default=8,
+                        help="Concurrent uploads in pipeline mode (default: 8).")
+    parser.add_argument('--max-pending-uploads', type=int, default=256,
+                        help="Outputs waiting for upload before rendering blocks in pipeline mode (default: 256).")
+    add_listing_arguments(parser)
+    return parser
+
+
+def check_run_arguments(parser, args):
+    """
+    Reject invalid options of `add_run_arguments` with `parser.error`, before the run touches S3.
+    """
+    check_zip_arguments(parser, args)
+    if args.archive_size and args.incremental:
+        parser.error("--archive-size cannot be combined with --incremental, archives are not updated in place")
+    return args
+
+
+def parse_run_args(description):
+    parser = add_run_arguments(argparse.ArgumentParser(description=description))
+    return check_run_arguments(parser, parser.parse_args())
+
+
+def shard_name(name, args):
+    """
+    Name of a run of the script `name`, with the shard appended when the ZIPs are sharded, so the logs, journals
+    and manifests of the shards do not overwrite each other.
+    """
+    if args.shard_count == 1:
+        return name
+    return f"{name}.shard-{args.shard_index}-of-{args.shard_count}"
+
+
+def output_name(name, args):
+    """
+    Name of the manifest and archives of the run `name`. Labels in another format have other keys and exported
+    rasters are additional outputs, so each of them keeps its own.
+    """
+    if getattr(args, 'label_format', 'png') != 'png':
+        name = f"{name}.{args.label_format}"
+    if getattr(args, 'export_rasters', False):
+        name = f"{name}.rasters"
+    return name
+
+
+def is_sketch_file(name):
+    return name.startswith(SKETCH_PREFIX) and name.endswith(SKETCH_POSTFIX)
+
+
+def is_raster_file(name):
+    return name.lower().endswith(RASTER_EXTENSIONS)
+
+
+def index_rasters(names):
+    """
+    Group the raster members of a ZIP by the attachment they are named after: `{attachment: [name, ...]}`.
+    """
+    rasters = {}
+    for name in names:
+        if is_raster_file(name):
+            rasters.setdefault(os.path.splitext(name.rsplit('/', 1)[-1])[0], []).append(name)
+    return rasters
+
+
+def find_raster(rasters, sketch_name, attachment):
+    """
+    The member holding the raster of an attachment. When several sketches of the ZIP name an attachment alike, the
+    member whose path names the sketch is taken.
+    """
+    candidates = rasters.get(attachment, [])
+    if len(candidates) > 1:
+        candidates = [name for name in candidates if sketch_name in name.split('/')]
+    return candidates[0] if len(candidates) == 1 else None
+
+
+def resize_raster(raster_data, image_shape):
+    """
+    Decode an attachment raster and resize it to TARGET_SHAPE, with the mapping from the attachment `image_shape`
+    that the labels use.
+    """
+    image = cv2.imdecode(np.frombuffer(raster_data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("the raster could not be decoded")
+    if image.shape[:2] != tuple(image_shape):
+        logging.warning(f"Raster of {image.shape[1]}x{image.shape[0]} differs from the attachment dimensions "
+                        f"{image_shape[1]}x{image_shape[0]}, it is stretched to the label shape.")
+    return cv2.resize(image, (TARGET_SHAPE[1], TARGET_SHAPE[0]), interpolation=cv2.INTER_AREA)
+
+
+def export_raster(raster_data, json_data, sketch_name, image_shape, attachment):
+    """
+    Write the resized raster of an attachment to RASTER_SUB_DIR and return its key. Takes the arguments of a
+    `process_fn` after the encoded raster, so it runs as a work unit of `read_zip`.
+    """
+    s3_key = f"{S3_MAIN_DIR}/{RASTER_SUB_DIR}/{sketch_name}.{attachment}.jpg"
     try:
-        # Download ZIP file from s3 to a temporary in-memory buffer
-        zip_obj = s3_client.get_object(Bucket=s3_bucket, Key=s3_key)
-        with zipfile.ZipFile(BytesIO(zip_obj['Body'].read()), 'r') as archive:
-            prefix, postfix = 'observations/snapshots/latest/', '.latest.json'
-            sketch_files = [x for x in archive.namelist() if x.startswith(prefix) and x.endswith(postfix)]
+        image = resize_raster(raster_data, image_shape)
+        _, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, RASTER_JPEG_QUALITY])
+        write_output(S3_BUCKET_NAME, s3_key, buffer.tobytes(), 'image/jpeg')
+        return s3_key
+    except Exception as e:
+        logging.error(f"Error exporting the raster of {sketch_name}.{attachment}: {e}")
+        raise
+
+
+def fetch_zip(s3_bucket, s3_key):
+    """
+    Open a ZIP file on S3 as a seekable file. With ranged access only the central directory and the sketch
+    snapshots are fetched, otherwise the whole archive is downloaded, to disk if it exceeds ZIP_MEMORY_LIMIT.
+    """
+    if ZIP_ACCESS == 'ranged':
+        return open_zip(s3_client, s3_bucket, s3_key, members=is_sketch_file)
+    return download_zip(s3_client, s3_bucket, s3_key, ZIP_MEMORY_LIMIT)
+
+
+class _SketchOutputs:
+    """
+    What one sketch produced. It is recorded in the manifest as soon as all of its attachment units completed, so a
+    checkpoint of the manifest never waits for the rest of the ZIP.
+    """
+    def __init__(self, manifest, zip_key, sketch_name, crc):
+        self.manifest = manifest
+        self.zip_key = zip_key
+        self.sketch_name = sketch_name
+        self.crc = crc
+        self.output_keys = []
+        self.payload = None
+        self.pending = 0
+        self.submitted = False
+        self.failed = False
+        self.recorded = False
+
+    def _record(self):
+        if self.submitted and self.pending == 0 and not self.failed:
+            self.manifest.record_sketch(self.zip_key, self.sketch_name, self.crc, self.output_keys, self.payload)
+            self.recorded = True
+
+    def unit_done(self, output_keys):
+        self.pending -= 1
+        if output_keys is not None:
+            self.output_keys.extend([output_keys] if isinstance(output_keys, str) else output_keys)
+        self._record()
+
+    def all_submitted(self):
+        self.submitted = True
+        self._record()
+
+
+def read_zip(s3_bucket, s3_key, process_fn, sketch_fn=None, runner=None, zip_file=None, manifest=None,
+             replay_fn=None):
+    """
+    Open a project ZIP once and hand every `latest` sketch to the given handlers.
+
+    `sketch_fn(json_data, sketch_name)` is called once per sketch and `process_fn(json_data, sketch_name,
+    image_shape, attachment)` once per attachment that has dimensions. Either of them may be None.
+    With a `parallel.UnitRunner` the attachments are processed on its worker processes. An already downloaded
+    `zip_file` is used instead of fetching `s3_key` again. With EXPORT_RASTERS the raster of every vectorized
+    attachment is exported as a unit of its own, see `export_raster`.
+
+    With a `manifest.Manifest` the sketches whose snapshot is unchanged are skipped, and `replay_fn` is called with
+    the payloads they stored. For the other sketches the manifest records the output keys returned by `process_fn`
+    and the payload returned by `sketch_fn`. Sketches for which a handler raised are not recorded, and neither is
+    their ZIP, so the next run processes them again.
+    """
+    sketch_names, rasters, sketch_outputs = None, None, []
+    try:
+        if zip_file is None:
+            zip_file = fetch_zip(s3_bucket, s3_key)
+        with zip_file, zipfile.ZipFile(zip_file, 'r') as archive:
+            sketch_files = [x for x in archive.namelist() if is_sketch_file(x)]
             for i, sketch_file in enumerate(sketch_files):
-                sketch_name = sketch_file[len(prefix):-len(postfix)]
+                sketch_name = sketch_file[len(SKETCH_PREFIX):-len(SKETCH_POSTFIX)]
+                outputs = None
+                if manifest is not None:
+                    crc = archive.getinfo(sketch_file).CRC
+                    if manifest.sketch_current(s3_key, sketch_name, crc):
+                        logging.info(f'Skipping unchanged sketch: {i}: {sketch_name}.')
+                        for payload in manifest.payloads(s3_key, sketch_name):
+                            replay_fn(payload)
+                        continue
+                    outputs = _SketchOutputs(manifest, s3_key, sketch_name, crc)
+                    sketch_outputs.append(outputs)
                 logging.info(f'Processing sketch: {i}: {sketch_name}.')
 
                 with archive.open(sketch_file, 'r') as afh:
-                    json_data = json.loads(afh.read())
+                    sketch_data = afh.read()
+                json_data = json.loads(sketch_data)
 
-                for attachment, details in json_data['attachments'].items():
+                if sketch_fn is not None:
+                    try:
+                        payload = sketch_fn(json_data, sketch_name)
+                        if outputs is not None:
+                            outputs.payload = payload
+                    except Exception as e:
+                        logging.error(f"Failed to process sketch {sketch_name}: {e}")
+                        if outputs is not None:
+                            outputs.failed = True
+
+                attachments = json_data['attachments'].items() if process_fn is not None or EXPORT_RASTERS else ()
+                for attachment, details in attachments:
                     try:
                         dimensions = details['properties']['dimensions']
                         height, width = dimensions[1], dimensions[0]
@@ -73,7 +866,49 @@ def read_zip(s3_bucket,s3_key, process_fn):
                         logging.warning(f"Missing 'dimensions' key for attachment: {attachment}. Skipping...")
                         continue
 
-                    # Fix argument order
-                    process_fn(json_data, sketch_name, image_shape, attachment)
+                    unit_fns = [] if process_fn is None else [process_fn]
+                    if EXPORT_RASTERS and details['properties'].get('vectorize', False):
+                        if rasters is None:
+                            rasters = index_rasters(archive.namelist())
+                        raster_file = find_raster(rasters, sketch_name, attachment)
+                        if raster_file is None:
+                            logging.warning(f"No raster found for attachment {sketch_name}.{attachment}")
+                        else:
+                            # The raster travels to the worker with the unit, decoding and resizing it is the work
+                            unit_fns.append(partial(export_raster, archive.read(raster_file)))
+
+                    for unit_fn in unit_fns:
+                        on_done = None
+                        if outputs is not None:
+                            outputs.pending += 1
+                            on_done = outputs.unit_done
+                        if runner is not None:
+                            runner.submit(unit_fn, (s3_key, sketch_name), sketch_data, image_shape, attachment,
+                                          on_done=on_done)
+                            continue
+                        # As on the worker processes, a failed unit leaves its sketch unrecorded but does not stop
+                        # the others
+                        try:
+                            output_keys = unit_fn(json_data, sketch_name, image_shape, attachment)
+                        except Exception as e:
+                            logging.error(f"Failed to process attachment {sketch_name}.{attachment}: {e}")
+                            continue
+                        if on_done is not None:
+                            on_done(output_keys)
+                if outputs is not None:
+                    outputs.all_submitted()
+            sketch_names = {x[len(SKETCH_PREFIX):-len(SKETCH_POSTFIX)] for x in sketch_files}
     except Exception as e:
         logging.error(f"Error processing ZIP file from S3: {e}")
+    finally:
+        if runner is not None:
+            runner.drain()
+        # A ZIP that failed half way, or in which a sketch failed, is looked at again in the next run
+        if manifest is not None and sketch_names is not None:
+            failed = [outputs.sketch_name for outputs in sketch_outputs if not outputs.recorded]
+            if failed:
+                logging.error(f"{len(failed)} sketches of {s3_key} failed and are processed again by the next run: "
+                              f"{', '.join(failed)}")
+                manifest.fail_zip(s3_key)
+            else:
+                manifest.finish_zip(s3_key, sketch_names)
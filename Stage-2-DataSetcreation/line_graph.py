@@ -0,0 +1,123 @@
+# line_graph.py
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+
+
+class LineGraph:
+    """
+    Undirected graph of the points of a sketch connected by its lines, built once per sketch.
+
+    The adjacency is kept as CSR arrays and the connected components are computed up front, so a corner pair
+    in different components is answered in O(1) instead of by exhausting a search. Connected pairs are found
+    with a bidirectional breadth-first search and memoized. Ties between equally short paths are not broken
+    symmetrically, so a path is only memoized for the direction it was searched in.
+    """
+    def __init__(self, point_ids, lines):
+        self.point_ids = list(point_ids)
+        self.rows = {point_id: row for row, point_id in enumerate(self.point_ids)}
+        starts, stops = [], []
+        for line in lines:
+            line_rows = [self._row(point_id) for point_id in line['points']]
+            starts.extend(line_rows[:-1])
+            stops.extend(line_rows[1:])
+        size = len(self.point_ids)
+        indptr, indices = self._csr(size, np.array(starts, dtype=np.int64), np.array(stops, dtype=np.int64))
+        adjacency = csr_matrix((np.ones(len(indices), dtype=np.int8), indices, indptr), shape=(size, size))
+        _, self.components = connected_components(adjacency, directed=False)
+        indptr, indices = indptr.tolist(), indices.tolist()
+        self.neighbors = [indices[indptr[row]:indptr[row + 1]] for row in range(size)]
+        self.paths = {}
+
+    @staticmethod
+    def _csr(size, starts, stops):
+        """
+        Symmetric CSR adjacency without duplicate edges or self-loops. The neighbors of every point keep the
+        order in which the lines first connect them, so ties between equally short paths are broken the same
+        way as by networkx.shortest_path on a graph built from the same lines.
+        """
+        edge_order = np.arange(len(starts))
+        rows = np.concatenate([starts, stops])
+        columns = np.concatenate([stops, starts])
+        edge_order = np.concatenate([edge_order, edge_order])
+        keep = rows != columns
+        rows, columns, edge_order = rows[keep], columns[keep], edge_order[keep]
+
+        # Keep the first occurrence of every (row, column) pair
+        keys = rows * size + columns
+        by_key = np.lexsort((edge_order, keys))
+        first = by_key[np.concatenate([[True], keys[by_key][1:] != keys[by_key][:-1]])] if len(keys) else by_key
+        rows, columns, edge_order = rows[first], columns[first], edge_order[first]
+
+        by_row = np.lexsort((edge_order, rows))
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=size))])
+        return indptr, columns[by_row]
+
+    def _row(self, point_id):
+        # Lines may reference points that are not listed in the sketch, they become nodes of their own
+        if point_id not in self.rows:
+            self.rows[point_id] = len(self.point_ids)
+            self.point_ids.append(point_id)
+        return self.rows[point_id]
+
+    def _search(self, source, target):
+        """
+        Bidirectional BFS between two rows of the same component, always expanding the smaller fringe.
+        """
+        forward, backward = {source: None}, {target: None}
+        forward_fringe, backward_fringe = [source], [target]
+        while True:
+            if len(forward_fringe) <= len(backward_fringe):
+                fringe, forward_fringe = forward_fringe, []
+                for row in fringe:
+                    for neighbor in self.neighbors[row]:
+                        if neighbor not in forward:
+                            forward[neighbor] = row
+                            forward_fringe.append(neighbor)
+                        if neighbor in backward:
+                            return self._join(forward, backward, neighbor)
+            else:
+                fringe, backward_fringe = backward_fringe, []
+                for row in fringe:
+                    for neighbor in self.neighbors[row]:
+                        if neighbor not in backward:
+                            backward[neighbor] = row
+                            backward_fringe.append(neighbor)
+                        if neighbor in forward:
+                            return self._join(forward, backward, neighbor)
+
+    @staticmethod
+    def _join(forward, backward, meeting):
+        path = []
+        row = meeting
+        while row is not None:
+            path.append(row)
+            row = forward[row]
+        path.reverse()
+        row = backward[meeting]
+        while row is not None:
+            path.append(row)
+            row = backward[row]
+        return path
+
+    def shortest_path(self, source, target):
+        """
+        Return the point ids of a shortest path from `source` to `target`, or None if they are not connected.
+        Raises KeyError for a point that is not in the graph.
+        """
+        source_row, target_row = self.rows[source], self.rows[target]
+        if self.components[source_row] != self.components[target_row]:
+            return None
+        if source_row == target_row:
+            return [source]
+        path = self.paths.get((source_row, target_row))
+        if path is None:
+            path = self._search(source_row, target_row)
+            self.paths[source_row, target_row] = path
+        return [self.point_ids[row] for row in path]
+
+    def shortest_paths(self, pairs):
+        """
+        Answer a batch of (source, target) queries, e.g. all consecutive corner pairs of the buildings.
+        """
+        return [self.shortest_path(source, target) for source, target in pairs]
@@ -0,0 +1,94 @@
+# listing.py
+import logging
+import hashlib
+import common
+from concurrent.futures import ThreadPoolExecutor
+
+# How many levels of sub-prefixes are expanded when fanning the listing out over threads
+MAX_FAN_OUT_DEPTH = 2
+
+
+def _object_info(obj):
+    return {'Key': obj['Key'], 'Size': obj['Size'], 'ETag': obj['ETag'].strip('"')}
+
+
+def list_objects(s3_bucket, prefix, suffix=''):
+    """
+    List every object below `prefix`, following continuation tokens past the first 1000 keys.
+    """
+    paginator = common.s3_client.get_paginator('list_objects_v2')
+    objects = []
+    for page in paginator.paginate(Bucket=s3_bucket, Prefix=prefix):
+        objects.extend(_object_info(obj) for obj in page.get('Contents', []) if obj['Key'].endswith(suffix))
+    return objects
+
+
+def _split_prefix(s3_bucket, prefix, suffix):
+    """
+    List the objects directly below `prefix` and the sub-prefixes one '/' level deeper.
+    """
+    paginator = common.s3_client.get_paginator('list_objects_v2')
+    objects, sub_prefixes = [], []
+    for page in paginator.paginate(Bucket=s3_bucket, Prefix=prefix, Delimiter='/'):
+        objects.extend(_object_info(obj) for obj in page.get('Contents', []) if obj['Key'].endswith(suffix))
+        sub_prefixes.extend(p['Prefix'] for p in page.get('CommonPrefixes', []))
+    return objects, sub_prefixes
+
+
+def list_zip_objects(s3_bucket, prefix, workers=1):
+    """
+    List all ZIP files below `prefix` with their size and ETag.
+
+    With more than one worker the sub-prefixes below `prefix` are listed in parallel threads.
+    """
+    if workers <= 1:
+        return list_objects(s3_bucket, prefix, '.zip')
+
+    objects, prefixes = [], [prefix]
+    for _ in range(MAX_FAN_OUT_DEPTH):
+        if len(prefixes) >= workers:
+            break
+        expanded = []
+        for sub_prefix in prefixes:
+            level_objects, sub_prefixes = _split_prefix(s3_bucket, sub_prefix, '.zip')
+            objects.extend(level_objects)
+            expanded.extend(sub_prefixes)
+        prefixes = expanded
+
+    if prefixes:
+        logging.info(f"Listing {len(prefixes)} prefixes below {prefix} on {workers} threads.")
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='list') as executor:
+        for prefix_objects in executor.map(lambda p: list_objects(s3_bucket, p, '.zip'), prefixes):
+            objects.extend(prefix_objects)
+    return sorted(objects, key=lambda obj: obj['Key'])
+
+
+def shard_of(s3_key, shard_count):
+    return int.from_bytes(hashlib.md5(s3_key.encode('utf-8')).digest()[:8], 'big') % shard_count
+
+
+def shard_zips(zip_objects, shard_index=0, shard_count=1):
+    """
+    Keep the ZIPs of shard `shard_index` out of `shard_count`. The shard of a ZIP follows from a stable hash of its
+    key, so nodes that list the same bucket agree on the partition without talking to each other, and a ZIP that
+    is added later does not move the others. All sketches of a ZIP are handled by one node, which keeps the mask
+    outputs and partial COCO files of the shards disjoint.
+    """
+    if not 0 <= shard_index < shard_count:
+        raise ValueError(f"Shard index {shard_index} is not in [0, {shard_count})")
+    if shard_count == 1:
+        return zip_objects
+    shard = [obj for obj in zip_objects if shard_of(obj['Key'], shard_count) == shard_index]
+    logging.info(f"Shard {shard_index} of {shard_count}: {len(shard)} of {len(zip_objects)} ZIPs, "
+                 f"{sum(obj['Size'] for obj in shard)} bytes.")
+    return shard
+
+
+def schedule_zips(zip_objects, order='largest-first'):
+    """
+    Return the ZIP keys in processing order. 'largest-first' hands out the biggest archives first
+    (longest-processing-time-first), so concurrent workers do not end with one huge archive in the tail.
+    """
+    if order == 'largest-first':
+        zip_objects = sorted(zip_objects, key=lambda obj: (-obj['Size'], obj['Key']))
+    return [obj['Key'] for obj in zip_objects]
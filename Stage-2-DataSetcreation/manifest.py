@@ -0,0 +1,261 @@
+# manifest.py
+import os
+import json
+import time
+import sqlite3
+import logging
+import common
+from tempfile import gettempdir
+from storage import TRANSFER_CONFIG
+from botocore.exceptions import ClientError
+
+S3_MANIFEST_DIR = "manifests/datasetcreation"
+# Suffix of the manifest name of a run journal, see `open_run_manifest`
+JOURNAL_SUFFIX = ".journal"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS zips (zip_key TEXT PRIMARY KEY, etag TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS sketches (zip_key TEXT NOT NULL, sketch_name TEXT NOT NULL, crc INTEGER NOT NULL,
+                                     payload TEXT, PRIMARY KEY (zip_key, sketch_name));
+CREATE TABLE IF NOT EXISTS outputs (zip_key TEXT NOT NULL, sketch_name TEXT NOT NULL, output_key TEXT NOT NULL,
+                                    PRIMARY KEY (zip_key, sketch_name, output_key));
+"""
+
+
+class Manifest:
+    """
+    Record which outputs every sketch produced, keyed on the ETag of its ZIP and the CRC32 of its snapshot in the
+    ZIP's central directory, so that later runs only process what changed.
+
+    ZIPs whose ETag is unchanged are skipped without being fetched, and in a changed ZIP only the sketches whose
+    snapshot CRC changed are processed again. Outputs of sketches and ZIPs that disappeared, and outputs that a
+    reprocessed sketch no longer produces, are deleted from `s3_bucket`. Sketch handlers that build state in this
+    process instead of uploading objects (the textbox COCO files) store a JSON payload that is replayed for skipped
+    sketches.
+
+    With a `checkpoint_interval` the manifest is uploaded that often while sketches are recorded, so a run that dies
+    can be resumed from it. A `journal` only lives until its run completed, see `open_run_manifest`.
+    """
+    def __init__(self, path, s3_bucket, checkpoint_interval=None, journal=False):
+        self.path = path
+        self.s3_bucket = s3_bucket
+        self.s3_key = manifest_key(os.path.basename(path))
+        self.db = sqlite3.connect(path)
+        self.db.executescript(_SCHEMA)
+        # ETags of the ZIPs in the current listing
+        self.etags = {}
+        self.checkpoint_interval = checkpoint_interval
+        self.journal = journal
+        self.last_checkpoint = time.monotonic()
+        # A `pipeline.WriteTracker` while outputs are written in the background. Sketches and ZIPs are then only
+        # recorded once all of their outputs are written, when the manifest is settled at a checkpoint
+        self.writes = None
+        self.deferred = []
+        self.failed_zips = set()
+
+    def _delete_outputs(self, where, params):
+        output_keys = [row[0] for row in self.db.execute(f"SELECT output_key FROM outputs WHERE {where}", params)]
+        for output_key in output_keys:
+            try:
+                common.delete_output(self.s3_bucket, output_key)
+            except Exception as e:
+                logging.error(f"Error deleting stale output s3://{self.s3_bucket}/{output_key}: {e}")
+        self.db.execute(f"DELETE FROM outputs WHERE {where}", params)
+        return len(output_keys)
+
+    def set_listing(self, zip_objects):
+        """
+        Take the ETags of the listed ZIPs and remove the outputs of the ZIPs that are no longer listed.
+        """
+        self.etags = {obj['Key']: obj['ETag'] for obj in zip_objects}
+        removed = [zip_key for zip_key, in self.db.execute("SELECT zip_key FROM zips")
+                   if zip_key not in self.etags]
+        for zip_key in removed:
+            deleted = self._delete_outputs("zip_key = ?", (zip_key,))
+            self.db.execute("DELETE FROM sketches WHERE zip_key = ?", (zip_key,))
+            self.db.execute("DELETE FROM zips WHERE zip_key = ?", (zip_key,))
+            logging.info(f"Removed ZIP {zip_key} from the manifest and deleted {deleted} of its outputs.")
+        self.db.commit()
+        current = sum(self.zip_current(zip_key) for zip_key in self.etags)
+        logging.info(f"Manifest: {current} of {len(self.etags)} ZIPs unchanged, {len(removed)} removed.")
+
+    def zip_current(self, zip_key):
+        row = self.db.execute("SELECT etag FROM zips WHERE zip_key = ?", (zip_key,)).fetchone()
+        return row is not None and row[0] == self.etags.get(zip_key)
+
+    def sketch_current(self, zip_key, sketch_name, crc):
+        row = self.db.execute("SELECT crc FROM sketches WHERE zip_key = ? AND sketch_name = ?",
+                              (zip_key, sketch_name)).fetchone()
+        return row is not None and row[0] == crc
+
+    def payloads(self, zip_key, sketch_name=None):
+        """
+        Yield the stored payloads of the sketches of a ZIP, or of a single sketch.
+        """
+        query, params = "SELECT payload FROM sketches WHERE zip_key = ?", (zip_key,)
+        if sketch_name is not None:
+            query, params = query + " AND sketch_name = ?", params + (sketch_name,)
+        for payload, in self.db.execute(query + " ORDER BY sketch_name", params):
+            if payload is not None:
+                yield json.loads(payload)
+
+    def record_sketch(self, zip_key, sketch_name, crc, output_keys, payload=None):
+        """
+        Record the outputs of a processed sketch, deleting the ones it produced before but no longer does.
+        """
+        self.deferred.append((zip_key, sketch_name, (crc, output_keys, payload)))
+        if self.writes is None:
+            self.settle()
+        self._maybe_checkpoint()
+
+    def finish_zip(self, zip_key, sketch_names):
+        """
+        Mark a ZIP as done at its listed ETag and forget the sketches it no longer contains.
+        """
+        self.deferred.append((zip_key, None, sketch_names))
+        if self.writes is None:
+            self.settle()
+        self._maybe_checkpoint()
+
+    def settle(self):
+        """
+        Apply the deferred records whose outputs are written. A sketch with a failed output is not recorded and
+        its ZIP is not finished, so the next run processes them again.
+        """
+        deferred, self.deferred = self.deferred, []
+        waiting_zips = set()
+        for entry in deferred:
+            zip_key, sketch_name, details = entry
+            if sketch_name is None:
+                if zip_key in waiting_zips:
+                    self.deferred.append(entry)
+                elif zip_key in self.failed_zips:
+                    logging.error(f"Not marking {zip_key} as done, it is processed again by the next run.")
+                else:
+                    self._finish_zip(zip_key, details)
+                continue
+            crc, output_keys, payload = details
+            state = 'written' if self.writes is None else self.writes.state(output_keys)
+            if state == 'pending':
+                self.deferred.append(entry)
+                waiting_zips.add(zip_key)
+            elif state == 'failed':
+                self.failed_zips.add(zip_key)
+                logging.error(f"Not recording sketch {sketch_name} of {zip_key}, some of its outputs failed.")
+            else:
+                self._record_sketch(zip_key, sketch_name, crc, output_keys, payload)
+
+    def fail_zip(self, zip_key):
+        """
+        Leave a ZIP in which sketches failed to the next run.
+        """
+        self.failed_zips.add(zip_key)
+
+    def _record_sketch(self, zip_key, sketch_name, crc, output_keys, payload):
+        output_keys = set(output_keys)
+        stale = [output_key for output_key, in self.db.execute(
+            "SELECT output_key FROM outputs WHERE zip_key = ? AND sketch_name = ?", (zip_key, sketch_name))
+                 if output_key not in output_keys]
+        for output_key in stale:
+            self._delete_outputs("zip_key = ? AND sketch_name = ? AND output_key = ?",
+                                 (zip_key, sketch_name, output_key))
+        self.db.execute("INSERT OR REPLACE INTO sketches VALUES (?, ?, ?, ?)",
+                        (zip_key, sketch_name, crc, None if payload is None else json.dumps(payload)))
+        self.db.executemany("INSERT OR IGNORE INTO outputs VALUES (?, ?, ?)",
+                            [(zip_key, sketch_name, output_key) for output_key in sorted(output_keys)])
+
+    def _finish_zip(self, zip_key, sketch_names):
+        removed = [sketch_name for sketch_name, in self.db.execute(
+            "SELECT sketch_name FROM sketches WHERE zip_key = ?", (zip_key,)) if sketch_name not in sketch_names]
+        for sketch_name in removed:
+            self._delete_outputs("zip_key = ? AND sketch_name = ?", (zip_key, sketch_name))
+            self.db.execute("DELETE FROM sketches WHERE zip_key = ? AND sketch_name = ?", (zip_key, sketch_name))
+        if removed:
+            logging.info(f"Removed {len(removed)} sketches that are no longer in {zip_key}.")
+        if zip_key in self.etags:
+            self.db.execute("INSERT OR REPLACE INTO zips VALUES (?, ?)", (zip_key, self.etags[zip_key]))
+        self.db.commit()
+
+    def _maybe_checkpoint(self):
+        if self.checkpoint_interval is not None and \
+                time.monotonic() - self.last_checkpoint >= self.checkpoint_interval:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """
+        Commit the manifest and upload it to S3. Sketches whose outputs are still being written are left for a later
+        checkpoint, and the ones with a failed output are dropped before the upload.
+        """
+        self.settle()
+        self.db.commit()
+        common.s3_client.upload_file(self.path, common.S3_BUCKET_NAME, self.s3_key, Config=TRANSFER_CONFIG)
+        self.last_checkpoint = time.monotonic()
+        logging.info(f"Manifest saved to S3: {self.s3_key}")
+
+    def save(self):
+        """
+        Upload the manifest to S3 for the next run and remove the local copy.
+        """
+        self.checkpoint()
+        self.db.close()
+        os.remove(self.path)
+
+    def discard(self):
+        """
+        Remove the manifest locally and from S3.
+        """
+        self.db.close()
+        os.remove(self.path)
+        common.s3_client.delete_object(Bucket=common.S3_BUCKET_NAME, Key=self.s3_key)
+        logging.info(f"Removed the manifest from S3: {self.s3_key}")
+
+    def close(self, completed):
+        """
+        Finish the run: the journal of a completed run is no longer needed, anything else is kept for the next run.
+        A run in which sketches failed keeps its journal, so --resume only processes their ZIPs again.
+        """
+        if self.journal and completed and not self.failed_zips:
+            self.discard()
+        else:
+            if self.journal and completed:
+                logging.warning(f"Keeping the journal, sketches of {len(self.failed_zips)} ZIPs failed.")
+            self.save()
+
+
+def manifest_key(file_name):
+    return f"{common.S3_MAIN_DIR}/{S3_MANIFEST_DIR}/{file_name}"
+
+
+def open_manifest(name, s3_bucket=common.S3_BUCKET_NAME, load=True, checkpoint_interval=None, journal=False):
+    """
+    Download the manifest `name` of a previous run from S3, or start an empty one.
+    """
+    path = os.path.join(gettempdir(), f"{name}.sqlite")
+    if os.path.exists(path):
+        os.remove(path)
+    if load:
+        try:
+            common.s3_client.download_file(common.S3_BUCKET_NAME, manifest_key(f"{name}.sqlite"), path,
+                                           Config=TRANSFER_CONFIG)
+            logging.info(f"Loaded the manifest of the previous run: {name}")
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+                raise
+            logging.info(f"No manifest found for {name}, processing everything.")
+    return Manifest(path, s3_bucket, checkpoint_interval, journal)
+
+
+def open_run_manifest(name, args, s3_bucket=common.S3_BUCKET_NAME):
+    """
+    Open the manifest of a run of the script `name`. With --incremental this is the manifest shared by all its
+    incremental runs. With --journal or --resume it is a journal of this run only: --resume continues the journal
+    of the last run that did not complete, and the journal is removed once the run completes. Otherwise the run
+    keeps no manifest and None is returned.
+    """
+    name = common.output_name(name, args)
+    if args.incremental:
+        return open_manifest(name, s3_bucket, checkpoint_interval=args.checkpoint_interval)
+    if not (args.journal or args.resume):
+        return None
+    return open_manifest(f"{name}{JOURNAL_SUFFIX}", s3_bucket, load=args.resume,
+                         checkpoint_interval=args.checkpoint_interval, journal=True)
@@ -0,0 +1,172 @@
+# parallel.py
+import os
+import json
+import logging
+import common
+from storage import is_shared
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# The parsed sketch of the last unit handled by this worker process, keyed by (s3_key, sketch_name)
+_cached_sketch = (None, None)
+
+
+class _RecordCollector(logging.Handler):
+    """
+    Keep the log records of one work unit so the parent process can emit them in submission order.
+    """
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        # Format the message now so the record can be pickled back to the parent
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        self.records.append(record)
+
+
+def _init_worker(render_options, output_options, storage_url):
+    # A boto3 client and its connection pool must not be shared across a fork
+    common.configure_storage(storage_url)
+    common.configure_rendering(**render_options)
+    common.configure_output(**output_options)
+
+    # Records are handed back to the parent, the inherited file and stream handlers stay untouched
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.setLevel(logging.INFO)
+
+
+def _load_sketch(sketch_id, sketch_data):
+    global _cached_sketch
+    if _cached_sketch[0] != sketch_id:
+        _cached_sketch = (sketch_id, json.loads(sketch_data))
+    return _cached_sketch[1]
+
+
+def _run_unit(process_fn, sketch_id, sketch_data, image_shape, attachment, collect_outputs):
+    collector = _RecordCollector()
+    root = logging.getLogger()
+    root.addHandler(collector)
+    outputs = []
+    ok, result = False, None
+    if collect_outputs:
+        # The parent owns the upload pool, so the outputs travel back with the log records
+        common.set_output_sink(lambda *output: outputs.append(output))
+    try:
+        json_data = _load_sketch(sketch_id, sketch_data)
+        result = process_fn(json_data, sketch_id[1], image_shape, attachment)
+        ok = True
+    except Exception as e:
+        logging.error(f"Failed to process attachment {sketch_id[1]}.{attachment}: {e}")
+    finally:
+        common.set_output_sink(None)
+        root.removeHandler(collector)
+    return collector.records, outputs, ok, result
+
+
+class UnitRunner:
+    """
+    Run the (sketch, attachment) work units of `common.read_zip` on a process pool.
+
+    The log records of every unit are emitted in the order the units were submitted, and an exception in one
+    unit is logged without affecting the others. At most `max_pending` units are in flight at any time.
+    Workers upload their outputs themselves unless an output sink is set in this process, in which case the
+    outputs are passed on to it. The `on_done` callback of a unit is called here with the value `process_fn`
+    returned, once the unit finished without an exception and all of its outputs were passed on.
+
+    A worker process that dies, e.g. killed for running out of memory, breaks the whole pool. The pool is then
+    replaced and the units that were in flight are run once more; a unit whose second run breaks the pool as well
+    fails.
+    """
+    def __init__(self, workers, max_pending=None):
+        self.workers = workers
+        self.executor = self._create_executor()
+        self.max_pending = max_pending or 4 * workers
+        self.pending = deque()
+
+    def _create_executor(self):
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                   initargs=(common.get_render_options(), common.get_output_options(),
+                                             common.STORAGE_URL))
+
+    def _submit(self, unit):
+        try:
+            return self.executor.submit(_run_unit, *unit)
+        except BrokenProcessPool:
+            self._restart()
+            return self.executor.submit(_run_unit, *unit)
+
+    def _restart(self):
+        """
+        Replace the broken pool and run the units it lost once more on the new one.
+        """
+        logging.warning("A worker process died, restarting the worker processes.")
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.executor = self._create_executor()
+        pending, self.pending = self.pending, deque()
+        for future, unit, on_done, retried in pending:
+            if not retried and isinstance(future.exception(), BrokenProcessPool):
+                future, retried = self.executor.submit(_run_unit, *unit), True
+            self.pending.append((future, unit, on_done, retried))
+
+    def submit(self, process_fn, sketch_id, sketch_data, image_shape, attachment, on_done=None):
+        # Outputs written to storage that only lives in this process, or checked against the listings of this
+        # process, travel back here as well
+        collect_outputs = common.get_output_sink() is not None or not is_shared(common.STORAGE_URL) or \
+            common.upload_filter is not None
+        unit = (process_fn, sketch_id, sketch_data, image_shape, attachment, collect_outputs)
+        future = self._submit(unit)
+        self.pending.append((future, unit, on_done, False))
+        self.drain(self.max_pending)
+
+    def drain(self, keep=0):
+        """
+        Wait for the oldest units until no more than `keep` are pending and emit their logs.
+        """
+        while len(self.pending) > keep:
+            future, unit, on_done, retried = self.pending.popleft()
+            try:
+                records, outputs, ok, result = future.result()
+            except BrokenProcessPool as e:
+                if not retried:
+                    self.pending.appendleft((future, unit, on_done, retried))
+                    self._restart()
+                    continue
+                logging.error(f"Failed to process attachment {unit[1][1]}.{unit[4]}, its worker process died: {e}")
+                continue
+            except Exception as e:
+                logging.error(f"Work unit failed in worker process: {e}")
+                continue
+            for record in records:
+                logging.getLogger(record.name).handle(record)
+            for output in outputs:
+                try:
+                    common.write_output(*output)
+                except Exception as e:
+                    logging.error(f"Error uploading s3://{output[0]}/{output[1]}: {e}")
+                    ok = False
+            if ok and on_done is not None:
+                on_done(result)
+
+    def shutdown(self):
+        self.drain()
+        self.executor.shutdown()
+
+
+def create_unit_runner(workers):
+    """
+    Return a `UnitRunner` for `workers` processes (0 means one per CPU), or None to process units in-line.
+    """
+    if workers == 0:
+        workers = os.cpu_count() or 1
+    if workers <= 1:
+        return None
+    logging.info(f"Processing attachments on {workers} worker processes.")
+    return UnitRunner(workers)
@@ -0,0 +1,163 @@
+# pipeline.py
+import logging
+import threading
+import common
+from collections import deque, Counter
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+
+
+class WriteTracker:
+    """
+    The keys of the outputs a background writer accepted but did not write yet, and of the ones it failed to write.
+    A manifest records a sketch only once all of its outputs are written, see `manifest.Manifest.writes`.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending_keys = Counter()
+        self.failed_keys = set()
+
+    def _started(self, s3_keys):
+        with self.lock:
+            self.pending_keys.update(s3_keys)
+
+    def _finished(self, s3_keys, failed=False):
+        with self.lock:
+            self.pending_keys.subtract(s3_keys)
+            for s3_key in s3_keys:
+                if self.pending_keys[s3_key] <= 0:
+                    del self.pending_keys[s3_key]
+            if failed:
+                self.failed_keys.update(s3_keys)
+
+    def state(self, s3_keys):
+        """
+        'failed' if one of the outputs failed, 'pending' while one of them is not written yet, otherwise 'written'.
+        """
+        with self.lock:
+            if any(s3_key in self.failed_keys for s3_key in s3_keys):
+                return 'failed'
+            if any(s3_key in self.pending_keys for s3_key in s3_keys):
+                return 'pending'
+        return 'written'
+
+
+class Uploader(WriteTracker):
+    """
+    Upload outputs on a thread pool. `submit` blocks once `max_pending` uploads are waiting, so rendering cannot
+    run arbitrarily far ahead of the network.
+    """
+    def __init__(self, workers, max_pending):
+        super().__init__()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='upload')
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.uploaded = 0
+        self.unchanged = 0
+        self.failed = 0
+
+    def submit(self, s3_bucket, s3_key, body, content_type):
+        self.slots.acquire()
+        self._started([s3_key])
+        try:
+            future = self.executor.submit(common.put_output, s3_bucket, s3_key, body, content_type)
+        except Exception:
+            self._finished([s3_key], failed=True)
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda f: self._done(f, s3_bucket, s3_key))
+
+    def _done(self, future, s3_bucket, s3_key):
+        self.slots.release()
+        error = future.exception()
+        with self.lock:
+            if error is not None:
+                self.failed += 1
+            elif future.result():
+                self.uploaded += 1
+            else:
+                self.unchanged += 1
+        self._finished([s3_key], failed=error is not None)
+        if error is not None:
+            logging.error(f"Error uploading s3://{s3_bucket}/{s3_key}: {error}")
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        logging.info(f"Uploaded {self.uploaded} outputs, {self.unchanged} unchanged and not uploaded, "
+                     f"{self.failed} failed.")
+
+
+def prefetch_zips(s3_bucket, zip_keys, depth):
+    """
+    Yield `(s3_key, future)` pairs in order while up to `depth` further ZIPs are downloaded in the background.
+    """
+    keys = iter(zip_keys)
+    with ThreadPoolExecutor(max_workers=depth, thread_name_prefix='prefetch') as executor:
+        pending = deque((s3_key, executor.submit(common.fetch_zip, s3_bucket, s3_key))
+                        for s3_key in islice(keys, depth))
+        while pending:
+            s3_key, future = pending.popleft()
+            next_key = next(keys, None)
+            if next_key is not None:
+                pending.append((next_key, executor.submit(common.fetch_zip, s3_bucket, next_key)))
+            yield s3_key, future
+
+
+def skip_unchanged_zips(zip_keys, manifest, replay_fn=None):
+    """
+    Drop the ZIPs whose ETag the manifest has already seen, replaying the payloads stored for their sketches.
+    """
+    changed = []
+    for s3_key in zip_keys:
+        if not manifest.zip_current(s3_key):
+            changed.append(s3_key)
+            continue
+        logging.info(f"Skipping unchanged ZIP file: {s3_key}")
+        if replay_fn is not None:
+            for payload in manifest.payloads(s3_key):
+                replay_fn(payload)
+    return changed
+
+
+def run_zips(s3_bucket, zip_keys, process_fn, sketch_fn=None, runner=None, options=None, manifest=None,
+             replay_fn=None, archive=None):
+    """
+    Process every ZIP in `zip_keys` with `common.read_zip`. With `options.pipeline` the ZIPs are downloaded
+    ahead and the outputs uploaded concurrently while the current ZIP is rendered. With a `manifest.Manifest`
+    unchanged ZIPs are not fetched at all. With an `archive.ArchiveWriter` the outputs are packed into its
+    archives instead of being uploaded one by one.
+    """
+    if manifest is not None:
+        zip_keys = skip_unchanged_zips(zip_keys, manifest, replay_fn)
+    zip_options = dict(runner=runner, manifest=manifest, replay_fn=replay_fn)
+    pipeline = options is not None and options.pipeline
+    uploader = Uploader(options.upload_workers, options.max_pending_uploads) if pipeline and archive is None else None
+    writer = archive if archive is not None else uploader
+    if writer is not None:
+        common.set_output_sink(archive.add if archive is not None else uploader.submit)
+    if manifest is not None:
+        # Sketches are recorded once their uploads, or the upload of their archive, succeeded
+        manifest.writes = writer
+    zips = prefetch_zips(s3_bucket, zip_keys, max(1, options.prefetch)) if pipeline else \
+        ((s3_key, None) for s3_key in zip_keys)
+    try:
+        for s3_key, future in zips:
+            logging.info(f"Processing ZIP files from S3: {s3_key}")
+            try:
+                zip_file = None if future is None else future.result()
+                common.read_zip(s3_bucket, s3_key, process_fn, sketch_fn, zip_file=zip_file, **zip_options)
+                logging.info(f"Successfully processed ZIP file: {s3_key}")
+            except Exception as e:
+                logging.error(f"Failed to process zip file {s3_key}: {e}")
+    finally:
+        if writer is not None:
+            common.set_output_sink(None)
+        if uploader is not None:
+            uploader.close()
+        if archive is not None:
+            archive.flush()
+        if manifest is not None:
+            # Every upload has finished, record the sketches that were waiting for theirs
+            manifest.settle()
+            manifest.writes = None
+        if common.upload_filter is not None:
+            logging.info(common.upload_filter.summary())
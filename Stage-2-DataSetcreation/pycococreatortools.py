@@ -1,8 +1,8 @@
 #!/usr/bin/env python3
 import re
 import datetime
+import cv2
 import numpy as np
-from itertools import groupby
 from skimage import measure
 from PIL import Image
 from pycocotools import mask
@@ -22,11 +22,16 @@ def close_contour(contour):
 
 def binary_mask_to_rle(binary_mask):
     rle = {'counts': [], 'size': list(binary_mask.shape)}
-    counts = rle.get('counts')
-    for i, (value, elements) in enumerate(groupby(binary_mask.ravel(order='F'))):
-        if i == 0 and value == 1:
-                counts.append(0)
-        counts.append(len(list(elements)))
+    pixels = binary_mask.ravel(order='F')
+    if pixels.size == 0:
+        return rle
+    # a run ends wherever the next pixel has a different value
+    run_ends = np.append(np.flatnonzero(pixels[1:] != pixels[:-1]) + 1, pixels.size)
+    counts = np.diff(run_ends, prepend=0).tolist()
+    # the counts start with a run of zeros, which may be empty
+    if pixels[0] == 1:
+        counts.insert(0, 0)
+    rle['counts'] = counts
 
     return rle
 
@@ -57,6 +62,46 @@ def binary_mask_to_polygon(binary_mask, tolerance=0):
 
     return polygons
 
+def clip_polygon(polygon, width, height):
+    """Clips a polygon to the image rectangle [0, width] x [0, height] (Sutherland-Hodgman)
+
+    Args:
+        polygon: an Nx2 array of (x, y) vertices
+
+    """
+    polygon = np.asarray(polygon, dtype=np.float64)
+    for axis, limit, keep_below in ((0, 0, False), (0, width, True), (1, 0, False), (1, height, True)):
+        if len(polygon) == 0:
+            break
+        inside = polygon[:, axis] <= limit if keep_below else polygon[:, axis] >= limit
+        clipped = []
+        for i in range(len(polygon)):
+            previous, current = polygon[i - 1], polygon[i]
+            if inside[i] != inside[i - 1]:
+                t = (limit - previous[axis]) / (current[axis] - previous[axis])
+                clipped.append(previous + t * (current - previous))
+            if inside[i]:
+                clipped.append(current)
+        polygon = np.array(clipped).reshape(-1, 2)
+    # the intersections may fall a rounding error outside the image
+    return np.clip(polygon, 0, [width, height])
+
+def polygon_area(polygon):
+    x, y = polygon[:, 0], polygon[:, 1]
+    return 0.5 * abs(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1)))
+
+def polygon_to_binary_mask(polygon, mask_shape):
+    """Rasterizes a polygon in pixel-edge coordinates, drawing only inside its bounding box"""
+    x0, y0 = np.floor(polygon.min(axis=0)).astype(int)
+    x1, y1 = np.ceil(polygon.max(axis=0)).astype(int)
+    roi = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+    # cv2 samples pixel centers, which sit at +0.5 in pixel-edge coordinates
+    points = np.round((polygon - [x0 + 0.5, y0 + 0.5]) * 16).astype(np.int32)
+    cv2.fillPoly(roi, [points], 1, lineType=cv2.LINE_8, shift=4)
+    binary_mask = np.zeros(mask_shape, dtype=np.bool_)
+    binary_mask[y0:y1, x0:x1] = roi
+    return binary_mask
+
 def create_image_info(image_id, file_name, image_size,
                       date_captured=datetime.datetime.utcnow().isoformat(' '),
                       license_id=1, coco_url="", flickr_url=""):
@@ -83,12 +128,42 @@ def create_annotation_info(annotation_id, image_id, category_info, binary_mask,
     binary_mask_encoded = mask.encode(np.asfortranarray(binary_mask.astype(np.uint8)))
 
     area = mask.area(binary_mask_encoded)
-    if area < 1:
-        return None
-
     if bounding_box is None:
         bounding_box = mask.toBbox(binary_mask_encoded)
 
+    return _annotation_info(annotation_id, image_id, category_info, binary_mask, area, bounding_box, tolerance)
+
+def create_annotation_infos(annotation_ids, image_id, category_info, binary_masks,
+                            image_size=None, tolerance=2, batch_size=64):
+    """Creates the annotations of several instances of one category in an image
+
+    The masks are RLE-encoded batch_size at a time with a single mask.encode call, and their
+    areas and bounding boxes are computed in bulk.
+
+    Args:
+        annotation_ids: the id of each annotation, in the order of binary_masks
+
+    Yields:
+        one annotation per mask, None where create_annotation_info would return None
+
+    """
+    for start in range(0, len(binary_masks), batch_size):
+        batch = binary_masks[start:start + batch_size]
+        if image_size is not None:
+            batch = [resize_binary_mask(binary_mask, image_size) for binary_mask in batch]
+
+        binary_masks_encoded = mask.encode(np.asfortranarray(np.stack(batch, axis=-1).astype(np.uint8)))
+        areas = mask.area(binary_masks_encoded)
+        bounding_boxes = mask.toBbox(binary_masks_encoded)
+
+        for offset, binary_mask in enumerate(batch):
+            yield _annotation_info(annotation_ids[start + offset], image_id, category_info, binary_mask,
+                                   areas[offset], bounding_boxes[offset], tolerance)
+
+def _annotation_info(annotation_id, image_id, category_info, binary_mask, area, bounding_box, tolerance):
+    if area < 1:
+        return None
+
     if category_info["is_crowd"]:
         is_crowd = 1
         segmentation = binary_mask_to_rle(binary_mask)
@@ -110,4 +185,48 @@ def create_annotation_info(annotation_id, image_id, category_info, binary_mask,
         "height": binary_mask.shape[0],
     }
 
+    return annotation_info
+
+def create_polygon_annotation_info(annotation_id, image_id, category_info, polygon, mask_shape):
+    """Creates the annotation of a polygon, e.g. a rotated text box, without rasterizing the whole image
+
+    The segmentation, bbox and area are computed from the polygon clipped to the image. Only crowd
+    annotations, whose segmentation is an RLE, rasterize the polygon, within its bounding box.
+
+    Args:
+        polygon: an Nx2 array of (x, y) vertices in pixel-edge coordinates, where pixel (0, 0) spans [0, 1] x [0, 1]
+        mask_shape: (height, width) of the image
+
+    """
+    polygon = clip_polygon(polygon, mask_shape[1], mask_shape[0])
+    if len(polygon) < 3:
+        return None
+
+    area = polygon_area(polygon)
+    if area < 1:
+        return None
+
+    x0, y0 = polygon.min(axis=0)
+    x1, y1 = polygon.max(axis=0)
+    bounding_box = [x0, y0, x1 - x0, y1 - y0]
+
+    if category_info["is_crowd"]:
+        is_crowd = 1
+        segmentation = binary_mask_to_rle(polygon_to_binary_mask(polygon, mask_shape))
+    else:
+        is_crowd = 0
+        segmentation = [polygon.ravel().tolist()]
+
+    annotation_info = {
+        "id": annotation_id,
+        "image_id": image_id,
+        "category_id": category_info["id"],
+        "iscrowd": is_crowd,
+        "area": float(area),
+        "bbox": [float(v) for v in bounding_box],
+        "segmentation": segmentation,
+        "width": mask_shape[1],
+        "height": mask_shape[0],
+    }
+
     return annotation_info
\ No newline at end of file
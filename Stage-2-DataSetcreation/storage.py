@@ -0,0 +1,335 @@
+# storage.py
+import io
+import os
+import shutil
+import hashlib
+import threading
+import datetime
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+# Environment variable with the default storage URL, see `create_client`
+STORAGE_ENV = "DATASET_STORAGE"
+# Keys returned per page of a local listing, as S3 does
+PAGE_SIZE = 1000
+# Suffix of the files a local upload is written to before it is moved into place
+TEMP_SUFFIX = ".upload-tmp"
+
+# Connections kept by the S3 client unless the run asks for more, see `create_client`
+POOL_CONNECTIONS = 10
+# Attempts per S3 call. The adaptive retry mode also rate-limits the client after SlowDown/throttling errors, so
+# a burst of uploads backs off instead of failing.
+MAX_ATTEMPTS = 10
+# upload_file/download_file split objects above the threshold into parts that are transferred concurrently
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=16 << 20, multipart_chunksize=16 << 20, max_concurrency=8)
+
+
+def _not_found(operation, key, code='NoSuchKey'):
+    return ClientError({'Error': {'Code': code, 'Message': f"The specified key does not exist: {key}"}}, operation)
+
+
+def _parse_range(range_header, size):
+    """
+    Resolve a `bytes=first-last` or `bytes=-suffix` Range header to the half-open [start, stop) of an object.
+    """
+    first, last = range_header[len('bytes='):].split('-')
+    if not first:
+        return max(0, size - int(last)), size
+    return int(first), min(size, int(last) + 1) if last else size
+
+
+class _Body:
+    """
+    The part of botocore's StreamingBody the scripts use: `read` and `iter_chunks`.
+    """
+    def __init__(self, file, length):
+        self.file = file
+        self.remaining = length
+
+    def read(self, amt=None):
+        # The file stays open until `close`, or until it is garbage collected, so reads past the end keep
+        # returning b'' as they do on botocore's body
+        amt = self.remaining if amt is None else min(amt, self.remaining)
+        if not amt:
+            return b''
+        data = self.file.read(amt)
+        self.remaining -= len(data)
+        return data
+
+    def iter_chunks(self, chunk_size=1024):
+        while True:
+            chunk = self.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def close(self):
+        self.file.close()
+
+
+def _object_response(file, size, etag, range_header=None):
+    response = {'ETag': etag, 'ContentLength': size}
+    if range_header is not None:
+        start, stop = _parse_range(range_header, size)
+        file.seek(start)
+        response['ContentLength'] = stop - start
+        response['ContentRange'] = f"bytes {start}-{stop - 1}/{size}"
+    response['Body'] = _Body(file, response['ContentLength'])
+    return response
+
+
+def _body_bytes(body):
+    if hasattr(body, 'read'):
+        body = body.read()
+    if isinstance(body, str):
+        return body.encode('utf-8')
+    return bytes(body)
+
+
+class _ListPaginator:
+    """
+    Pages of a `list_objects_v2` listing, with the `Contents` and `CommonPrefixes` that S3 returns.
+    """
+    def __init__(self, list_fn):
+        self.list_fn = list_fn
+
+    def paginate(self, Bucket, Prefix='', Delimiter=None, **kwargs):
+        entries, prefixes = [], set()
+        for key, size, etag, modified in self.list_fn(Bucket, Prefix):
+            rest = key[len(Prefix):]
+            if Delimiter and Delimiter in rest:
+                common_prefix = Prefix + rest[:rest.index(Delimiter) + len(Delimiter)]
+                if common_prefix not in prefixes:
+                    prefixes.add(common_prefix)
+                    entries.append({'Prefix': common_prefix})
+                continue
+            entries.append({'Key': key, 'Size': size, 'ETag': etag, 'LastModified': modified})
+        for start in range(0, max(1, len(entries)), PAGE_SIZE):
+            page_entries = entries[start:start + PAGE_SIZE]
+            page = {'KeyCount': len(page_entries)}
+            contents = [entry for entry in page_entries if 'Key' in entry]
+            common_prefixes = [entry for entry in page_entries if 'Prefix' in entry]
+            if contents:
+                page['Contents'] = contents
+            if common_prefixes:
+                page['CommonPrefixes'] = common_prefixes
+            yield page
+
+
+class LocalClient:
+    """
+    Keep the objects as files below `root`, at `<root>/<bucket>/<key>`. Implements the calls of the boto3 S3 client
+    the scripts use, and raises the same ClientError for missing objects, so a local copy of the corpus can stand in
+    for the bucket. Writes go to a temporary file that is moved into place, so readers never see a partial object.
+    The ETag is derived from the size and modification time of the file instead of its MD5.
+    """
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def _path(self, bucket, key):
+        return os.path.join(self.root, bucket, *key.split('/'))
+
+    @staticmethod
+    def _etag(stat):
+        return f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+    def _write(self, bucket, key, write_fn):
+        path = self._path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}{TEMP_SUFFIX}"
+        try:
+            write_fn(temp_path)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        try:
+            file = open(self._path(Bucket, Key), 'rb')
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            raise _not_found('GetObject', Key)
+        stat = os.fstat(file.fileno())
+        return _object_response(file, stat.st_size, self._etag(stat), Range)
+
+    def head_object(self, Bucket, Key, **kwargs):
+        try:
+            stat = os.stat(self._path(Bucket, Key))
+        except (FileNotFoundError, NotADirectoryError):
+            raise _not_found('HeadObject', Key, '404')
+        return {'ContentLength': stat.st_size, 'ETag': self._etag(stat)}
+
+    def put_object(self, Bucket, Key, Body=b'', **kwargs):
+        data = _body_bytes(Body)
+
+        def write(temp_path):
+            with open(temp_path, 'wb') as out_file:
+                out_file.write(data)
+        self._write(Bucket, Key, write)
+        return {}
+
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None, Config=None):
+        self._write(Bucket, Key, lambda temp_path: shutil.copyfile(Filename, temp_path))
+
+    def download_file(self, Bucket, Key, Filename, ExtraArgs=None, Config=None):
+        self.head_object(Bucket, Key)
+        shutil.copyfile(self._path(Bucket, Key), Filename)
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        try:
+            os.remove(self._path(Bucket, Key))
+        except FileNotFoundError:
+            pass
+        return {}
+
+    def _list(self, bucket, prefix):
+        bucket_dir = os.path.join(self.root, bucket)
+        # Only the directory the prefix points into has to be walked
+        top = os.path.join(bucket_dir, *prefix.split('/')[:-1])
+        keys = []
+        for dir_path, _, file_names in os.walk(top):
+            dir_key = os.path.relpath(dir_path, bucket_dir).replace(os.sep, '/')
+            for file_name in file_names:
+                key = file_name if dir_key == '.' else f"{dir_key}/{file_name}"
+                if key.startswith(prefix) and not file_name.endswith(TEMP_SUFFIX):
+                    keys.append(key)
+        for key in sorted(keys):
+            try:
+                stat = os.stat(self._path(bucket, key))
+            except FileNotFoundError:
+                continue
+            modified = datetime.datetime.fromtimestamp(stat.st_mtime, datetime.timezone.utc)
+            yield key, stat.st_size, self._etag(stat), modified
+
+    def get_paginator(self, operation_name):
+        if operation_name != 'list_objects_v2':
+            raise NotImplementedError(f"LocalClient does not paginate {operation_name}")
+        return _ListPaginator(self._list)
+
+
+class MemoryClient:
+    """
+    Keep the objects in a dict, with the same calls as `LocalClient`. The objects only live in this process.
+    """
+    def __init__(self):
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def _get(self, bucket, key, operation, code='NoSuchKey'):
+        with self.lock:
+            if (bucket, key) not in self.objects:
+                raise _not_found(operation, key, code)
+            return self.objects[bucket, key]
+
+    def _put(self, bucket, key, data):
+        etag = f'"{hashlib.md5(data).hexdigest()}"'
+        with self.lock:
+            self.objects[bucket, key] = (data, etag, datetime.datetime.now(datetime.timezone.utc))
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        data, etag, _ = self._get(Bucket, Key, 'GetObject')
+        return _object_response(io.BytesIO(data), len(data), etag, Range)
+
+    def head_object(self, Bucket, Key, **kwargs):
+        data, etag, _ = self._get(Bucket, Key, 'HeadObject', '404')
+        return {'ContentLength': len(data), 'ETag': etag}
+
+    def put_object(self, Bucket, Key, Body=b'', **kwargs):
+        self._put(Bucket, Key, _body_bytes(Body))
+        return {}
+
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None, Config=None):
+        with open(Filename, 'rb') as in_file:
+            self._put(Bucket, Key, in_file.read())
+
+    def download_file(self, Bucket, Key, Filename, ExtraArgs=None, Config=None):
+        data, _, _ = self._get(Bucket, Key, 'HeadObject', '404')
+        with open(Filename, 'wb') as out_file:
+            out_file.write(data)
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        with self.lock:
+            self.objects.pop((Bucket, Key), None)
+        return {}
+
+    def _list(self, bucket, prefix):
+        with self.lock:
+            objects = sorted((key, value) for (object_bucket, key), value in self.objects.items()
+                             if object_bucket == bucket and key.startswith(prefix))
+        for key, (data, etag, modified) in objects:
+            yield key, len(data), etag, modified
+
+    def get_paginator(self, operation_name):
+        if operation_name != 'list_objects_v2':
+            raise NotImplementedError(f"MemoryClient does not paginate {operation_name}")
+        return _ListPaginator(self._list)
+
+
+class SkipUnchanged:
+    """
+    Skip uploads of bytes an object already holds. The first upload into a directory lists that directory once and
+    keeps the ETags, which for objects written with a single put_object (and without KMS encryption) are the MD5 of
+    their content, as `MemoryClient` does as well. Other ETags never match, so such objects are always written.
+    Counts the written and skipped uploads.
+    """
+    def __init__(self):
+        self.etags = {}
+        self.lock = threading.Lock()
+        self.written = 0
+        self.skipped = 0
+
+    def _directory_etags(self, client, bucket, directory):
+        with self.lock:
+            if (bucket, directory) not in self.etags:
+                etags = {}
+                for page in client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=directory,
+                                                                             Delimiter='/'):
+                    etags.update((obj['Key'], obj['ETag'].strip('"')) for obj in page.get('Contents', []))
+                self.etags[bucket, directory] = etags
+            return self.etags[bucket, directory]
+
+    def put_object(self, client, Bucket, Key, Body=b'', **kwargs):
+        """
+        `client.put_object` unless the object already holds `Body`. Returns whether it was written.
+        """
+        data = _body_bytes(Body)
+        directory = Key[:Key.rfind('/') + 1]
+        if self._directory_etags(client, Bucket, directory).get(Key) == hashlib.md5(data).hexdigest():
+            with self.lock:
+                self.skipped += 1
+            return False
+        client.put_object(Bucket=Bucket, Key=Key, Body=data, **kwargs)
+        with self.lock:
+            self.written += 1
+        return True
+
+    def summary(self):
+        return f"{self.written} outputs written, {self.skipped} unchanged outputs skipped."
+
+
+def create_client(url=None, pool_connections=POOL_CONNECTIONS):
+    """
+    Create the storage client for `url`, which defaults to the DATASET_STORAGE environment variable:
+    's3' (the default) for the boto3 S3 client, 'file://<directory>' or a plain directory for a `LocalClient`, and
+    'memory://' for a `MemoryClient`. The S3 client keeps `pool_connections` connections, which should cover the
+    threads that share it, and retries in adaptive mode.
+    """
+    url = url or os.environ.get(STORAGE_ENV) or 's3'
+    if url == 's3':
+        config = Config(max_pool_connections=max(pool_connections, POOL_CONNECTIONS), tcp_keepalive=True,
+                        retries={'mode': 'adaptive', 'total_max_attempts': MAX_ATTEMPTS})
+        return boto3.client('s3', config=config)
+    if url.startswith('memory:'):
+        return MemoryClient()
+    directory = url[len('file://'):] if url.startswith('file://') else url
+    return LocalClient(directory)
+
+
+def is_shared(url=None):
+    """
+    Whether other processes see the objects of the storage at `url`, which is not the case for the in-memory one.
+    """
+    url = url or os.environ.get(STORAGE_ENV) or 's3'
+    return not url.startswith('memory:')
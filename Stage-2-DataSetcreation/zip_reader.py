@@ -0,0 +1,235 @@
+# zip_reader.py
+import io
+import mmap
+import logging
+import zipfile
+from tempfile import TemporaryFile
+from collections import OrderedDict
+
+# Granularity of the ranged reads and of the block cache
+BLOCK_SIZE = 1 << 18
+# Blocks fetched past the end of a read that misses the cache
+READ_AHEAD = 4
+# Blocks kept per open archive, grown by `prefetch` to hold everything it was asked for
+CACHE_BLOCKS = 64
+# Bytes read from the end of the object when it is opened. zipfile looks for the end of central directory record
+# in the last 64 KiB, and for most project ZIPs the central directory itself fits in the rest.
+TAIL_SIZE = 1 << 18
+# Archives larger than this are downloaded to a temporary file and memory-mapped instead of held in a BytesIO
+MEMORY_LIMIT = 256 << 20
+# Size of the chunks streamed from S3 to the temporary file
+DOWNLOAD_CHUNK_SIZE = 8 << 20
+
+
+class RangedS3File(io.RawIOBase):
+    """
+    Read-only, seekable view of an S3 object that fetches only the byte ranges that are read, using HTTP Range
+    requests. Data is fetched in BLOCK_SIZE blocks, READ_AHEAD blocks past a cache miss, and kept in an LRU cache.
+    """
+    def __init__(self, s3_client, s3_bucket, s3_key, block_size=BLOCK_SIZE, read_ahead=READ_AHEAD,
+                 cache_blocks=CACHE_BLOCKS, tail_size=TAIL_SIZE):
+        super().__init__()
+        self.s3_client = s3_client
+        self.s3_bucket = s3_bucket
+        self.s3_key = s3_key
+        self.block_size = block_size
+        self.read_ahead = read_ahead
+        self.cache_blocks = cache_blocks
+        self.blocks = OrderedDict()
+        self.position = 0
+        self.requests = 0
+        self.bytes_fetched = 0
+        # The first request reads the tail of the archive and tells us the size of the object
+        self.tail_start, self.tail, self.size = self._get_tail(tail_size)
+
+    def _get(self, range_header):
+        response = self.s3_client.get_object(Bucket=self.s3_bucket, Key=self.s3_key, Range=range_header)
+        data = response['Body'].read()
+        self.requests += 1
+        self.bytes_fetched += len(data)
+        return response, data
+
+    def _get_tail(self, tail_size):
+        response, data = self._get(f'bytes=-{tail_size}')
+        content_range = response.get('ContentRange')
+        # Without a Content-Range header the server sent the whole object
+        size = int(content_range.rsplit('/', 1)[1]) if content_range else len(data)
+        return size - len(data), data, size
+
+    def _fetch_blocks(self, first, last):
+        """Fetch blocks `first` to `last` (inclusive) with a single ranged request."""
+        start = first * self.block_size
+        stop = min((last + 1) * self.block_size, self.size)
+        _, data = self._get(f'bytes={start}-{stop - 1}')
+        for index in range(first, last + 1):
+            offset = index * self.block_size - start
+            self.blocks[index] = data[offset:offset + self.block_size]
+
+    def _evict(self):
+        while len(self.blocks) > self.cache_blocks:
+            self.blocks.popitem(last=False)
+
+    def _missing_runs(self, indices):
+        """Group the uncached block indices into runs of consecutive blocks."""
+        runs = []
+        for index in indices:
+            if index in self.blocks:
+                continue
+            if runs and runs[-1][1] == index - 1:
+                runs[-1][1] = index
+            else:
+                runs.append([index, index])
+        return runs
+
+    def prefetch(self, ranges):
+        """
+        Fetch the given `(start, stop)` byte ranges, merging them into as few requests as possible, so that reading
+        them later is served from the cache.
+        """
+        indices = set()
+        for start, stop in ranges:
+            # Ranges inside the tail that was read on open need no blocks
+            start, stop = max(start, 0), min(stop, self.size, self.tail_start)
+            if start < stop:
+                indices.update(range(start // self.block_size, (stop - 1) // self.block_size + 1))
+        indices = sorted(indices)
+        self.cache_blocks = max(self.cache_blocks, len(indices) + self.read_ahead)
+        for first, last in self._missing_runs(indices):
+            self._fetch_blocks(first, last)
+        self._evict()
+
+    def _read_range(self, start, stop):
+        if start >= self.tail_start:
+            return self.tail[start - self.tail_start:stop - self.tail_start]
+        first, last = start // self.block_size, (stop - 1) // self.block_size
+        last_block = (self.size - 1) // self.block_size
+        for run_first, run_last in self._missing_runs(range(first, last + 1)):
+            # Read ahead after the last missing block, but not into blocks that are already cached
+            if run_last == last:
+                while run_last < min(last + self.read_ahead, last_block) and run_last + 1 not in self.blocks:
+                    run_last += 1
+            self._fetch_blocks(run_first, run_last)
+        chunks = []
+        for index in range(first, last + 1):
+            self.blocks.move_to_end(index)
+            chunks.append(self.blocks[index])
+        self._evict()
+        offset = first * self.block_size
+        return b''.join(chunks)[start - offset:stop - offset]
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        if position < 0:
+            raise ValueError(f"Negative seek position {position}")
+        self.position = position
+        return position
+
+    def read(self, size=-1):
+        stop = self.size if size is None or size < 0 else min(self.position + size, self.size)
+        if stop <= self.position:
+            return b''
+        data = self._read_range(self.position, stop)
+        self.position = stop
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            logging.debug(f"Read {self.bytes_fetched} of {self.size} bytes of {self.s3_key} "
+                          f"in {self.requests} requests.")
+            self.blocks.clear()
+            self.tail = b''
+        super().close()
+
+
+class MappedFile(io.RawIOBase):
+    """
+    Read-only file over a memory mapping. mmap objects have read/seek/tell but no `seekable` before Python 3.13,
+    which zipfile needs.
+    """
+    def __init__(self, mapping):
+        super().__init__()
+        self.mapping = mapping
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.mapping.tell()
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self.mapping.seek(offset, whence)
+        return self.mapping.tell()
+
+    def read(self, size=-1):
+        return self.mapping.read(size if size is not None and size >= 0 else None)
+
+    def readinto(self, buffer):
+        data = self.mapping.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.mapping.close()
+        super().close()
+
+
+def member_range(info):
+    """Byte range of a ZIP member: its local header (assuming the central directory's extra field) and data."""
+    header_size = zipfile.sizeFileHeader + len(info.orig_filename.encode('utf-8')) + len(info.extra)
+    return info.header_offset, info.header_offset + header_size + info.compress_size
+
+
+def open_zip(s3_client, s3_bucket, s3_key, members=None):
+    """
+    Open a ZIP on S3 for random access with ranged reads. Only the tail of the archive holding the central directory
+    is read up front; with a `members(name)` predicate the matching members are fetched as well, in as few requests
+    as possible.
+    """
+    zip_file = RangedS3File(s3_client, s3_bucket, s3_key)
+    if members is not None:
+        with zipfile.ZipFile(zip_file, 'r') as archive:
+            zip_file.prefetch(member_range(info) for info in archive.infolist() if members(info.filename))
+    return zip_file
+
+
+def download_zip(s3_client, s3_bucket, s3_key, memory_limit=MEMORY_LIMIT):
+    """
+    Download a whole ZIP from S3 to a seekable file. Archives up to `memory_limit` bytes are read into a BytesIO,
+    larger ones are streamed to a temporary file in chunks and memory-mapped, so the page cache rather than the
+    process heap holds them.
+    """
+    zip_obj = s3_client.get_object(Bucket=s3_bucket, Key=s3_key)
+    if zip_obj['ContentLength'] <= memory_limit:
+        return io.BytesIO(zip_obj['Body'].read())
+    logging.info(f"Spilling {zip_obj['ContentLength']} bytes of {s3_key} to disk.")
+    # The temporary file is deleted once it is closed and the mapping of it is released
+    with TemporaryFile() as spill_file:
+        for chunk in zip_obj['Body'].iter_chunks(DOWNLOAD_CHUNK_SIZE):
+            spill_file.write(chunk)
+        spill_file.flush()
+        return MappedFile(mmap.mmap(spill_file.fileno(), 0, access=mmap.ACCESS_READ))